@@ -1,16 +1,64 @@
 #!/usr/bin/python
 
 import numpy as np
-from nipy.io.nifti_ref import nifti2nipy
 
-from coord_transform import voxcoord_to_mm, mm_to_voxcoord
-from coord_transform import get_3D_coordmap, get_coordmap_array
+import profiling
+from coord_transform import apply_affine, ImageGeometry
 from image_info import is_valid_coordinate, are_compatible_imgs
+from image_info import get_grid_signature
+from label_table import LabelTable
+from mask_intersect import mask_to_atlas_voxels, get_inside_voxels
+from mask_intersect import get_voxels_bbox, get_num_mask_volumes
+from mask_intersect import get_mask_sums, get_zero_values
+from mask_intersect import iter_mask_atlas_voxels
+from chunked_reader import iter_chunks, iter_volume_chunks
+from chunked_reader import get_chunk_voxels, read_voxel_values
+from quantized_volume import quantize_volume
+from sparse_atlas import SparseProbIndex
+from structure_stats import structure_stats_from_dict
+from structure_stats import compute_prob_stats, compute_label_stats
+
+
+def _divide(num, den):
+    '''
+    Returns num/den, or 0 where den is not positive. num and den can also be
+    arrays of per-volume or per-structure values.
+    '''
+    if np.ndim(num) == 0 and np.ndim(den) == 0:
+        return float(num)/den if den > 0 else 0.
+
+    num, den = np.broadcast_arrays(np.asarray(num, dtype=float), den)
+
+    values = np.zeros(num.shape)
+    positive = den > 0
+    values[positive] = num[positive]/den[positive]
+
+    return values
+
+
+def _add_padded(total, values):
+    '''
+    Returns total + values, padding the shorter of both with zeros along
+    their first axis. total can be None.
+    '''
+    if total is None:
+        return values
+
+    n_rows = max(len(total), len(values))
+    result = np.zeros((n_rows,) + np.shape(values)[1:])
+    result[:len(total)] += total
+    result[:len(values)] += values
+
+    return result
 
 
 class Atlas:
     '''
     Stores atlases data
+
+    The subclasses provide compute_structure_stats, query_mask_table and
+    get_cluster_sums, which get_structure_stats, query_mask_all and
+    query_cluster_table rely on.
     '''
 
     def __init__(self, imgs, summs, name): 
@@ -30,16 +78,159 @@ class Atlas:
         self.images = imgs
         self.summaries = summs
 
-        self.labels = {}
+        self.labels = LabelTable()
         self.references = {}
 
-        self.cursors = {}
-
         self.image = self.images[0]
         self.summary = self.summaries[0]
 
         self.type = ''
 
+        self.geometries = {}
+        self._data_loaded = set()
+
+        self.metadata_cache = None
+        self.image_files = {}
+        self._structure_stats = {}
+
+        self.memory_budget = None
+
+        self.image_grids = self._index_grids(self.images)
+        self.summary_grids = self._index_grids(self.summaries)
+
+
+    def _index_grids(self, imgs):
+        '''
+        Returns a dict from the grid signature of each image in imgs to the
+        image, see image_info.get_grid_signature.
+        '''
+        grids = {}
+        for img in imgs:
+            grids.setdefault(get_grid_signature(self.get_geometry(img)), img)
+
+        return grids
+
+
+    def load_data(self):
+        '''
+        Loads the data of self.image, so later queries, and worker processes
+        forked afterwards, find it in memory. Atlases with a memory budget
+        are not loaded.
+        '''
+        if self.memory_budget is None:
+            self.get_data()
+
+
+    def get_data(self):
+        '''
+        Returns the data array of self.image. The first access to the data
+        of each atlas image, which reads and decompresses its file, is
+        recorded in the profiling report.
+        '''
+        img_id = id(self.image)
+        if img_id in self._data_loaded:
+            return self.image.get_data()
+
+        with profiling.span('atlas_data_read'):
+            vol = self.image.get_data()
+
+        profiling.count('atlas_bytes_read', vol.nbytes)
+        self._data_loaded.add(img_id)
+
+        return vol
+
+
+    def set_memory_budget(self, memory_budget):
+        '''
+        Sets the maximum number of bytes of atlas data that queries read at
+        once. With a budget, queries read the image through its nibabel
+        array proxy, in chunks of structure volumes and z-slabs of the
+        voxels they need, see chunked_reader, instead of loading the whole
+        atlas volume. Structure stats that are not in the metadata cache and
+        max probability maps and the SparseProbIndex are computed in chunks
+        within the budget as well. The results kept for later queries, like
+        the max probability maps, are not counted in the budget.
+
+        Parameters
+        ----------
+        memory_budget: int
+        Bytes, None to load the whole volume in memory.
+        '''
+        self.memory_budget = memory_budget
+
+
+    def _reads_chunks(self):
+        '''
+        Returns True if queries read self.image in chunks within the memory
+        budget, which they do unless its data is already in memory.
+        '''
+        return (self.memory_budget is not None and
+                id(self.image) not in self._data_loaded)
+
+
+    def set_metadata_cache(self, metadata_cache, image_files):
+        '''
+        Sets the cache where the StructureStats of the atlas images are
+        kept, see get_structure_stats.
+
+        Parameters
+        ----------
+        metadata_cache: atlas_cache.MetadataCache
+
+        image_files: list of strings
+        File path of each of self.images.
+        '''
+        self.metadata_cache = metadata_cache
+        self.image_files = dict((id(img), img_file) for img, img_file
+                                in zip(self.images, image_files))
+
+
+    def get_structure_stats(self):
+        '''
+        Returns the StructureStats of self.image: the probability mass,
+        voxel count, centroid and bounding box of every structure.
+        They are computed once per atlas image and kept in the metadata
+        cache, if the atlas has one, for the next runs.
+        '''
+        img_id = id(self.image)
+        if img_id in self._structure_stats:
+            return self._structure_stats[img_id]
+
+        img_file = self.image_files.get(img_id)
+
+        entry = None
+        stats = None
+        if self.metadata_cache is not None and img_file is not None:
+            entry = self.metadata_cache.get(img_file) or {}
+            if self.type in entry:
+                stats = structure_stats_from_dict(entry[self.type])
+                profiling.count('structure_stats_cache_hits')
+
+        if stats is None:
+            with profiling.span('structure_stats'):
+                stats = self.compute_structure_stats()
+
+            if entry is not None:
+                entry[self.type] = stats.to_dict()
+                self.metadata_cache.put(img_file, entry)
+
+        self._structure_stats[img_id] = stats
+
+        return stats
+
+
+    def get_structure_centroid(self, struct_idx):
+        '''
+        Returns the x, y, z mm coordinates of the centroid of structure
+        struct_idx in self.image, None if the structure has no voxels.
+        '''
+        stats = self.get_structure_stats()
+        if not 0 <= struct_idx < len(stats) or not stats.n_voxels[struct_idx]:
+            return None
+
+        return tuple(apply_affine(self.get_geometry().affine,
+                                  stats.centroids[struct_idx]))
+
 
     def get_volume(self, pos):
         '''
@@ -67,7 +258,7 @@ class Atlas:
         -------
         string
         '''
-        return self.labels[pos] if self.labels.has_key(pos) else None
+        return self.labels.get(pos)
 
 
     def add_label(self, n, name):
@@ -81,7 +272,18 @@ class Atlas:
         -------
         a tuple: (label_value, string)
         '''
-        self.labels[n] = name
+        self.labels.add(n, name)
+
+
+    def set_label_table(self, label_table):
+        '''
+        Replaces all the atlas labels with the ones in label_table.
+
+        Parameters
+        ----------
+        label_table: LabelTable
+        '''
+        self.labels = label_table
 
 
     def get_labels_ids(self):
@@ -99,55 +301,611 @@ class Atlas:
 
     def select_compatible_images(self, ref_img):
         '''
-        Sets self.image and self.summary to images compatible with ref_image
+        Sets self.image and self.summary to images compatible with ref_image.
+        Images on the same grid as ref_image, with the same shape and affine,
+        are looked up by grid signature first; otherwise images with the
+        same shape are selected.
 
         Parameters
         ----------
         ref_img: nib.Nifti1Image or Nipy Image
         '''
-        for atlas_img in self.images:
-            if are_compatible_imgs(atlas_img, ref_img):
-                self.image = atlas_img
+        ref_grid = get_grid_signature(ref_img)
+
+        if ref_grid in self.image_grids:
+            self.image = self.image_grids[ref_grid]
+        else:
+            for atlas_img in self.images:
+                if are_compatible_imgs(atlas_img, ref_img):
+                    self.image = atlas_img
+
+        if ref_grid in self.summary_grids:
+            self.summary = self.summary_grids[ref_grid]
+        else:
+            for atlas_summ in self.summaries:
+                if are_compatible_imgs(atlas_summ, ref_img):
+                    self.summary = atlas_summ
+
+
+    def _get_voxel_index(self, x, y, z):
+        '''
+        Returns the voxel of self.image nearest to the x, y, z coordinate in
+        mm.
+
+        Parameters
+        ----------
+        x, y, z: float
+        Coordinates in mm
+
+        Returns
+        -------
+        Triplet of int voxel coordinates
+        '''
+        with profiling.span('coord_transform'):
+            vox = self.get_geometry().mm_to_voxcoord(x, y, z)
+
+        return tuple(np.round(vox).astype(int))
+
+
+    def get_geometry(self, img=None):
+        '''
+        Returns the ImageGeometry of img, self.image by default, with its
+        precomputed affines and coordinate map. It is created once per atlas
+        image and reused by all the coordinate transforms.
+
+        Parameters
+        ----------
+        img: nib.Nifti1Image
+        One of the atlas images or summaries.
+
+        Returns
+        -------
+        ImageGeometry
+        '''
+        if img is None:
+            img = self.image
+
+        img_id = id(img)
+        if img_id not in self.geometries:
+            self.geometries[img_id] = ImageGeometry(img)
+
+        return self.geometries[img_id]
+
+
+    def coords_to_voxels(self, coords):
+        '''
+        Returns the voxels of self.image nearest to each of the mm
+        coordinates in coords, all transformed with one affine product.
+
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
+
+        Returns
+        -------
+        vox_idx: (N, 3) int array of voxel coordinates
+
+        inside: (N, ) boolean array
+        True for the voxels that lie inside the atlas volume.
+        '''
+        coords = np.atleast_2d(np.asarray(coords, dtype=float))
+        profiling.count('coords_transformed', len(coords))
+
+        with profiling.span('coord_transform'):
+            vox_idx = apply_affine(self.get_geometry().inv_affine, coords)
+            vox_idx = np.round(vox_idx).astype(int)
+
+        return vox_idx, get_inside_voxels(vox_idx, self.image.shape)
+
+
+    def describe_coords(self, coords, threshold=None):
+        '''
+        Returns the structure found at each of the mm coordinates in coords.
+        For every coordinate this is the structure with the highest
+        probability, see probabilities_at.
+
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
+
+        threshold: float
+        Not used here, see StatsAtlas.describe_coords.
+
+        Returns
+        -------
+        struct_idx: (N, ) int array
+        Index of the structure at each coordinate, -1 where there is none.
+
+        names: list of N strings
+        Name of the structure at each coordinate.
+
+        probs: (N, n_structures) array
+        Probability of every structure at each coordinate.
+        '''
+        probs = self.probabilities_at(coords)
+
+        n_coords = len(probs)
+        struct_idx = -np.ones(n_coords, dtype=int)
+        if probs.shape[1] > 0:
+            max_idx = np.argmax(probs, axis=1)
+            found = probs[np.arange(n_coords), max_idx] > 0
+            struct_idx[found] = max_idx[found]
+
+        names = self.get_structure_names(struct_idx)
+
+        return struct_idx, names, probs
+
+
+    def iter_mask_voxels(self, mask_img):
+        '''
+        Maps the non-zero voxels of mask_img to the atlas voxels, all at
+        once, or one z-slab of mask_img at a time if there is a memory
+        budget, see mask_intersect.iter_mask_atlas_voxels. Mask queries add
+        up their results over all the pieces.
+
+        Parameters
+        ----------
+        mask_img: nib.Nifti1Image or nipy Image
+        3D or 4D mask.
+
+        Returns
+        -------
+        Iterator of (atlas_idx, weights, mask_sums) tuples, see
+        mask_intersect.iter_mask_atlas_voxels.
+        '''
+        if self.memory_budget is None:
+            atlas_idx, weights = mask_to_atlas_voxels(mask_img,
+                                                      self.get_geometry())
+            return iter([(atlas_idx, weights, get_mask_sums(mask_img))])
+
+        return iter_mask_atlas_voxels(mask_img, self.get_geometry(),
+                                      self.memory_budget)
+
+
+    def query_mask_all(self, mask_img, measure='avgprob'):
+        '''
+        Calculates measure for every structure of the atlas in one pass, see
+        query_mask_table.
+
+        Parameters
+        ----------
+        mask_img: nib.Nifti1Image or nipy Image
+        3D or 4D mask.
+
+        measure: string
+        'avgprob' for the average probability of the atlas voxels in the mask
+        or 'roiover' for the ROI overlap percentage.
+
+        Returns
+        -------
+        dict with the value of measure for each structure index, or with the
+        array of values of every mask volume for 4D masks.
+        '''
+        values = self.get_table_columns(self.query_mask_table(mask_img,
+                                                              measure))
+
+        if get_num_mask_volumes(mask_img) is None:
+            for struct_idx in values:
+                values[struct_idx] = values[struct_idx][0]
+
+        return values
+
+
+    def get_table_columns(self, table):
+        '''
+        Returns a dict with the column of table of each structure index,
+        zeros for the structures without a column.
+
+        Parameters
+        ----------
+        table: (n_rows, n_structures) array
+        See query_mask_table.
+        '''
+        values = {}
+        for struct_idx in self.get_labels_ids():
+            if 0 <= struct_idx < table.shape[1]:
+                values[struct_idx] = table[:, struct_idx]
+            else:
+                values[struct_idx] = np.zeros(len(table))
+
+        return values
+
+
+    def query_cluster_table(self, cluster_img, n_clusters,
+                            measure='avgprob'):
+        '''
+        Calculates measure for every cluster of cluster_img and every
+        structure of the atlas, with one pass over the cluster voxels.
+
+        Parameters
+        ----------
+        cluster_img: nib.Nifti1Image
+        3D image with the cluster number of every voxel, from 1 to
+        n_clusters, and 0 outside of the clusters.
+
+        n_clusters: int
+
+        measure: string
+        'avgprob' for the average probability of each structure in the
+        cluster or 'roiover' for the percentage of each structure covered
+        by the cluster.
+
+        Returns
+        -------
+        (n_clusters, n_structures) array
+        '''
+        if measure not in ('avgprob', 'roiover'):
+            raise ValueError('Unknown measure ' + str(measure))
+
+        cluster_sums = self.get_cluster_sums(cluster_img, n_clusters)
 
-        for atlas_summ in self.summaries:
-            if are_compatible_imgs(atlas_summ, ref_img):
-                self.summary = atlas_summ
+        if measure == 'avgprob':
+            clusters = np.asarray(cluster_img.get_data()).ravel()
+            sizes = np.bincount(clusters, minlength=n_clusters + 1)[1:]
+            return _divide(cluster_sums, sizes[:, np.newaxis])
+
+        mass = self.get_structure_stats().mass
+
+        norm = np.zeros(cluster_sums.shape[1])
+        n_structs = min(len(norm), len(mass))
+        norm[:n_structs] = mass[:n_structs]
+
+        return _divide(cluster_sums, norm[np.newaxis, :])
 
 
     def get_structure_name(self, index):
         '''
         '''
-        return self.labels[index] if self.labels.has_key(index) else 'Unknown'
+        return self.labels.get(index, 'Unknown')
+
+
+    def get_structure_names(self, indices):
+        '''
+        Returns the names of all the structure indices at once, 'Unknown'
+        for the ones that are not atlas labels.
+
+        Parameters
+        ----------
+        indices: int array-like
+
+        Returns
+        -------
+        list of strings
+        '''
+        return self.labels.get_names(indices, 'Unknown')
+
+
+    def add_centre(self, n, x, y, z, v):
+        '''
+        '''
+        self.labels.set_centre(n, (x, y, z, v))
+
+
+    def get_centre(self, n):
+        '''
+        Returns the (x, y, z, v) centre of label n, None if there is no such
+        label.
+        '''
+        return self.labels.get_centre(n)
+
+
+
+class StatsAtlas (Atlas):
+    '''
+    Stores statistical atlases data
+    '''
+
+    # number of coordinates from which probabilities_at builds and uses the
+    # sparse index instead of reading the rows of the probability volume
+    sparse_min_coords = 10000
+
+
+    def __init__(self, imgs, summs, name, lower, upper, precision, 
+                 stats_name, units): 
+        '''
+        imgs: list of nib.Nifti1Image
+        summs: list of nib.Nifti1Image
+        name: string
+        Atlas name
+        '''
+        Atlas.__init__(self, imgs, summs, name)
+
+        self.lower = lower
+        self.upper = upper
+        self.precision = precision
+        self.stats_name = stats_name
+        self.units = units
+
+        self.type = 'stat'
+
+        self.compact = False
+        self._prob_volumes = {}
+
+        self._sparse_indices = {}
+        self._max_prob_maps = {}
+
+
+    def load_data(self):
+        '''
+        Loads the data of self.image and its per-structure stats, so later
+        queries, and worker processes forked afterwards, find them ready.
+        '''
+        if self.memory_budget is None:
+            self.get_prob_volume()
+        self.get_structure_stats()
+
+
+    def set_compact(self, compact):
+        '''
+        Sets whether the probability volumes are kept quantized in memory.
+
+        Parameters
+        ----------
+        compact: boolean
+        True to keep them as integer percentages, in uint8, or scaled
+        uint16 for atlases with decimal precision, which takes one byte or
+        two per voxel and structure, see quantized_volume.QuantizedVolume.
+        Volumes whose values are not exact at the atlas precision are kept
+        as they are.
+        '''
+        self.compact = compact
+
+
+    def get_prob_volume(self):
+        '''
+        Returns the probability volume of self.image, which all the queries
+        read. It is the data array of self.image, or its QuantizedVolume in
+        compact mode, which is indexed in the same way and gives the same
+        values.
+        '''
+        if not self.compact:
+            return self.get_data()
+
+        img_id = id(self.image)
+        if img_id not in self._prob_volumes:
+            prob_vol = self.get_data()
+
+            with profiling.span('volume_quantize'):
+                quantized = quantize_volume(prob_vol, self.precision)
+
+            if quantized is None:
+                profiling.count('quantize_fallbacks')
+                self._prob_volumes[img_id] = prob_vol
+            else:
+                profiling.count('quantized_bytes_saved',
+                                prob_vol.nbytes - quantized.nbytes)
+                self._prob_volumes[img_id] = quantized
+                # drop the decompressed copy kept by nibabel
+                self.image.uncache()
+
+        return self._prob_volumes[img_id]
+
+
+    def compute_structure_stats(self):
+        '''
+        Returns the StructureStats of self.image
+        '''
+        if self._reads_chunks():
+            return compute_prob_stats(self.image.dataobj, self.memory_budget)
+
+        return compute_prob_stats(self.get_prob_volume())
+
+
+    def get_prob_sums(self):
+        '''
+        Returns the sum of the probabilities of each structure volume of
+        self.image, see get_structure_stats.
+        '''
+        return self.get_structure_stats().mass
+
+
+    def get_sparse_index(self):
+        '''
+        Returns the SparseProbIndex of self.image, building it the first
+        time it is asked for. Building it takes a pass over every structure
+        volume, so it is only built for processes answering many coordinate
+        lookups: the query server, coordinate batches and probabilities_at
+        on many coordinates. Once built, all the lookups of probabilities
+        at given voxels use it, see _read_probs and _lookup_voxel. Within a
+        memory budget it is built one chunk at a time.
+        '''
+        img_id = id(self.image)
+        if img_id not in self._sparse_indices:
+            with profiling.span('sparse_index_build'):
+                if self._reads_chunks():
+                    sparse_index = SparseProbIndex(self.image.dataobj,
+                                                   self.memory_budget)
+                else:
+                    sparse_index = SparseProbIndex(self.get_prob_volume())
+            self._sparse_indices[img_id] = sparse_index
+
+        return self._sparse_indices[img_id]
+
+
+    def _lookup_voxel(self, i, j, k):
+        '''
+        Returns the structures with non-zero probability at voxel i, j, k
+        and their probabilities. They are taken from the SparseProbIndex if
+        it has been built, see get_sparse_index, otherwise from the row of
+        probabilities of the voxel.
+
+        Returns
+        -------
+        structs: int array of structure indices, in ascending order
+
+        probs: array with the probability of each structure
+        '''
+        sparse_index = self._sparse_indices.get(id(self.image))
+        if sparse_index is not None:
+            return sparse_index.lookup(i, j, k)
+
+        probs = self._read_probs(([i], [j], [k]))[0]
+        structs = np.flatnonzero(probs)
+
+        return structs, probs[structs]
+
+
+    def _compute_max_prob_map(self, threshold=0):
+        '''
+        Returns the 3D map of the index of the structure with the highest
+        probability at every voxel of self.image, -1 where that probability
+        is not above threshold, computed one structure volume at a time, or
+        one chunk at a time within a memory budget.
+        '''
+        if self._reads_chunks():
+            chunks = iter_volume_chunks(self.image.dataobj,
+                                        self.memory_budget)
+        else:
+            chunks = iter_volume_chunks(self.get_prob_volume())
+
+        max_probs = np.zeros(self.image.shape[:3])
+        max_prob_map = -np.ones(self.image.shape[:3], dtype=np.int32)
+
+        for offset, vol_pos, chunk in chunks:
+            region = tuple(slice(o, o + n) for o, n in zip(offset,
+                                                          chunk.shape[:3]))
+            region_probs = max_probs[region]
+            region_map = max_prob_map[region]
+
+            for n, v in enumerate(vol_pos):
+                vol = chunk[..., n]
+                higher = vol > region_probs
+                region_probs[higher] = vol[higher]
+                region_map[higher] = v
+
+        max_prob_map[max_probs <= threshold] = -1
+
+        return max_prob_map
+
+
+    def get_max_prob_map(self, threshold=0):
+        '''
+        Returns the 3D map of the index of the structure with the highest
+        probability at every voxel of self.image, -1 where that probability
+        is not above threshold, like the FSL maxprob-thr<threshold> images.
+        The unthresholded map is computed from the probability volume, one
+        structure volume at a time; the atlas summary images are not used,
+        since FSL ships them already thresholded. Thresholded maps only read
+        the probability volume at the structure of each voxel given by the
+        unthresholded map, or are computed in chunks within a memory
+        budget.
+        Maps are kept for later queries, one per atlas image and threshold.
+
+        Parameters
+        ----------
+        threshold: float
+        Probability threshold, in the units of the atlas, e.g. 0, 25 or 50.
+
+        Returns
+        -------
+        3D int32 numpy array
+        '''
+        key = (id(self.image), threshold)
+        if key in self._max_prob_maps:
+            return self._max_prob_maps[key]
+
+        with profiling.span('max_prob_map'):
+            if threshold == 0 or self._reads_chunks():
+                max_prob_map = self._compute_max_prob_map(threshold)
+            else:
+                max_prob_map = self.get_max_prob_map(0).copy()
+
+                vox_idx = np.nonzero(max_prob_map >= 0)
+                max_probs = self.get_prob_volume()[vox_idx +
+                                            (max_prob_map[vox_idx],)]
+
+                below = max_probs <= threshold
+                max_prob_map[tuple(idx[below] for idx in vox_idx)] = -1
+
+        self._max_prob_maps[key] = max_prob_map
+
+        return max_prob_map
+
+
+    def get_max_structures(self, coords, threshold=0):
+        '''
+        Returns the structure with the highest probability at each of the mm
+        coordinates in coords, and its probability. The structures are
+        looked up in the max probability map, so the probability volume is
+        only read at one structure per coordinate, or, within a memory
+        budget, from the probabilities of all the structures at the
+        coordinates.
+
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
+
+        threshold: float
+        See get_max_prob_map.
+
+        Returns
+        -------
+        struct_idx: (N, ) int array
+        Index of the structure at each coordinate, -1 where there is none
+        above threshold.
+
+        probs: (N, ) array
+        Probability of the structure at each coordinate.
+        '''
+        if self._reads_chunks():
+            all_probs = self.probabilities_at(coords)
+            struct_idx = np.argmax(all_probs, axis=1)
+            probs = all_probs[np.arange(len(all_probs)), struct_idx]
+
+            below = probs <= threshold
+            struct_idx[below] = -1
+            probs[below] = 0
+
+            return struct_idx, probs
+
+        vox_idx, inside = self.coords_to_voxels(coords)
+
+        struct_idx = -np.ones(len(inside), dtype=int)
+        struct_idx[inside] = self.get_max_prob_map(threshold)[
+                                                tuple(vox_idx[inside].T)]
+
+        prob_vol = self.get_prob_volume()
+
+        found = struct_idx >= 0
+        probs = np.zeros(len(inside), dtype=prob_vol.dtype)
+        probs[found] = prob_vol[tuple(vox_idx[found].T) +
+                                (struct_idx[found],)]
+
+        return struct_idx, probs
 
 
-    def add_centre(self, n, x, y, z, v):
-        '''
+    def describe_coords(self, coords, threshold=None):
         '''
-        self.cursors[n] = (x, y, z, v)
+        Returns the structure found at each of the mm coordinates in coords,
+        see Atlas.describe_coords. With a threshold, it is the structure
+        with the highest probability if it is above threshold, found with
+        get_max_structures, and only its probability is returned.
 
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
 
+        threshold: float
+        See get_max_prob_map.
 
-class StatsAtlas (Atlas):
-    '''
-    Stores statistical atlases data
-    '''
-    def __init__(self, imgs, summs, name, lower, upper, precision, 
-                 stats_name, units): 
-        '''
-        imgs: list of nib.Nifti1Image
-        summs: list of nib.Nifti1Image
-        name: string
-        Atlas name
+        Returns
+        -------
+        struct_idx: (N, ) int array
+        Index of the structure at each coordinate, -1 where there is none.
+
+        names: list of N strings
+        Name of the structure at each coordinate.
+
+        probs: (N, n_structures) array, or (N, ) array with a threshold
+        Probability of every structure, or of the structure found, at each
+        coordinate.
         '''
-        Atlas.__init__(self, imgs, summs, name)
+        if threshold is None:
+            return Atlas.describe_coords(self, coords)
 
-        self.lower = lower
-        self.upper = upper
-        self.precision = precision
-        self.stats_name = stats_name
-        self.units = units
+        struct_idx, probs = self.get_max_structures(coords, threshold)
 
-        self.type = 'stat'
+        return struct_idx, self.get_structure_names(struct_idx), probs
 
 
     def get_probability(self, struct_idx, x, y, z):
@@ -170,16 +928,94 @@ class StatsAtlas (Atlas):
         a float value of the probability
 
         '''
-        i, j, k = mm_to_voxcoord(self.image, x, y, z)
+        i, j, k = self._get_voxel_index(x, y, z)
 
         if self.image.shape[3] <= struct_idx:
             return 0
 
-        if is_valid_coordinate(self.image, i, j, k):
-            return self.image.get_data()[i, j, k, struct_idx]
-        else:
+        if not is_valid_coordinate(self.image, i, j, k):
             return 0
 
+        return self._read_probs(([i], [j], [k]), [struct_idx])[0, 0]
+
+
+    def _read_probs(self, vox_idx, structs=None):
+        '''
+        Returns the probabilities of the structures at the voxels vox_idx,
+        from the SparseProbIndex if it has been built, see
+        get_sparse_index, or read in chunks if there is a memory budget.
+
+        Parameters
+        ----------
+        vox_idx: tuple of three int arrays
+        Voxel indices.
+
+        structs: sorted int array-like
+        Indices of the structures, all of them by default.
+
+        Returns
+        -------
+        (N, n_structures) array
+        '''
+        sparse_index = self._sparse_indices.get(id(self.image))
+        if sparse_index is not None:
+            return sparse_index.get_values(vox_idx, structs)
+
+        if self._reads_chunks():
+            return read_voxel_values(self.image.dataobj, vox_idx,
+                                     self.memory_budget, structs)
+
+        prob_vol = self.get_prob_volume()
+        if structs is None:
+            return prob_vol[vox_idx]
+
+        vox_idx = tuple(np.asarray(idx)[:, np.newaxis] for idx in vox_idx)
+
+        return prob_vol[vox_idx + (np.asarray(structs, dtype=int),)]
+
+
+    def probabilities_at(self, coords, struct_idx=None):
+        '''
+        Returns the probability values of every structure at each of the mm
+        coordinates in coords. Coordinates outside of the atlas get 0.
+        From sparse_min_coords coordinates on, they are looked up in the
+        SparseProbIndex, which is built if needed, see get_sparse_index.
+
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
+
+        struct_idx: int
+        Index of the atlas' structure of interest. If given, only the
+        probabilities of this structure are returned.
+
+        Returns
+        -------
+        (N, n_structures) array, or (N, ) array if struct_idx is given
+        '''
+        vox_idx, inside = self.coords_to_voxels(coords)
+        vox_idx = tuple(vox_idx[inside].T)
+
+        if len(inside) >= self.sparse_min_coords:
+            self.get_sparse_index()
+
+        n_structs = self.image.shape[3]
+
+        if struct_idx is not None:
+            structs = [struct_idx] if 0 <= struct_idx < n_structs else []
+            values = self._read_probs(vox_idx, structs)
+
+            probs = np.zeros(len(inside), dtype=values.dtype)
+            if structs:
+                probs[inside] = values[:, 0]
+        else:
+            values = self._read_probs(vox_idx)
+
+            probs = np.zeros((len(inside), n_structs), dtype=values.dtype)
+            probs[inside] = values
+
+        return probs
+
 
     def _get_roi_mask_intersect(self, mask_img, struct_idx):
         '''
@@ -191,27 +1027,33 @@ class StatsAtlas (Atlas):
 
         Returns
         -------
-        The total sum of 
+        masked_probs:
+        The total sum of the structure probabilities weighted by the mask
+        values, an array with one sum per volume for 4D masks.
 
+        mask_sums:
+        The sum of the mask values, see mask_intersect.get_mask_sums.
         '''
-        mask_vol = np.array(mask_img.get_data())
+        stats = self.get_structure_stats()
 
-        if self.image.shape[3] <= struct_idx:
-            return 0
+        masked_probs = get_zero_values(mask_img)
+        mask_sums = 0.
+        for atlas_idx, weights, slab_sums in self.iter_mask_voxels(mask_img):
+            mask_sums = mask_sums + slab_sums
 
-        prob_img = nifti2nipy(self.image)
-        prob_vol = prob_img[:, :, :, struct_idx]
+            if not len(weights):
+                continue
 
-        masked_probs = 0.
+            overlapping = stats.find_overlapping(*get_voxels_bbox(atlas_idx))
+            if struct_idx not in overlapping:
+                continue
 
-        mask_cm = get_3D_coordmap(mask_img)
-        prob_cm = get_3D_coordmap(prob_img)
+            with profiling.span('intersection'):
+                probs = self._read_probs(atlas_idx, [struct_idx])[:, 0]
+                masked_probs = masked_probs + np.dot(probs.astype(float),
+                                                     weights)
 
-        for idx in np.argwhere(mask_vol):
-            voxc = mm_to_voxcoord(prob_cm, *voxcoord_to_mm(mask_cm, *idx))
-            masked_probs += prob_vol[tuple(voxc)] * mask_vol[tuple(idx)]
-
-        return masked_probs
+        return masked_probs, mask_sums
 
 
     def get_avg_probability(self, mask_img, struct_idx):
@@ -222,29 +1064,23 @@ class StatsAtlas (Atlas):
         Parameters
         ----------
         mask_img: nib.Nifti1Image
+        3D or 4D mask.
 
         struct_idx: int
         Index of the atlas' structure of interest.
 
         Returns
         -------
-        float number of the resulting average probability
+        float number of the resulting average probability, or array with
+        the average probability of each volume for 4D masks
         '''
-        mask_img = nifti2nipy(mask_img)
-        mask_vol = mask_img.get_data()
-
         if self.image.shape[3] <= struct_idx:
-            return 0
-
-        prob_img = nifti2nipy(self.image)
-        prob_vol = prob_img[:, :, :, struct_idx]
+            return get_zero_values(mask_img)
 
-        total = 0.
-        mask_sum = np.sum(mask_vol)
+        masked_probs, mask_sum = self._get_roi_mask_intersect(mask_img,
+                                                              struct_idx)
 
-        masked_probs = self._get_roi_mask_intersect(mask_img, struct_idx)
-
-        return masked_probs/mask_sum if mask_sum > 0 else 0
+        return _divide(masked_probs, mask_sum)
 
 
     def get_roi_overlap(self, mask_img, struct_idx):
@@ -255,6 +1091,7 @@ class StatsAtlas (Atlas):
         Parameters
         ----------
         mask_img: nib.Nifti1Image
+        3D or 4D mask.
 
         struct_idx: int
         Index of the atlas' structure of interest.
@@ -264,24 +1101,160 @@ class StatsAtlas (Atlas):
 
         Returns
         -------
-        float number of the resulting ROI overlap percentage
+        float number of the resulting ROI overlap percentage, or array with
+        the overlap of each volume for 4D masks
         '''
-        mask_img = nifti2nipy(mask_img)
-        mask_vol = mask_img.get_data()
-
         if self.image.shape[3] <= struct_idx:
-            return 0
+            return get_zero_values(mask_img)
+
+        prob_sum = self.get_prob_sums()[struct_idx]
+
+        masked_probs = self._get_roi_mask_intersect(mask_img, struct_idx)[0]
+
+        return _divide(masked_probs, prob_sum)
+
+
+    def _add_masked_probs(self, masked_probs, atlas_idx, weights):
+        '''
+        Adds to masked_probs the probabilities of every structure at the
+        atlas voxels atlas_idx weighted by every mask volume, with one
+        matrix product over the structures whose bounding box meets the
+        mask voxels.
+
+        Parameters
+        ----------
+        masked_probs: (n_volumes, n_structures) float array
+
+        atlas_idx: tuple of three int arrays
+
+        weights: (N, n_volumes) float array
+        '''
+        bbox_min, bbox_max = get_voxels_bbox(atlas_idx)
+        overlapping = self.get_structure_stats().find_overlapping(bbox_min,
+                                                                  bbox_max)
+        profiling.count('structures_skipped',
+                        masked_probs.shape[1] - len(overlapping))
+
+        if self._reads_chunks():
+            # accumulated one chunk of atlas data at a time
+            chunks = iter_chunks(self.image.dataobj, bbox_min, bbox_max,
+                                 self.memory_budget, overlapping)
+            for offset, vol_pos, chunk in chunks:
+                sel, chunk_idx = get_chunk_voxels(atlas_idx, offset,
+                                                  chunk.shape)
+                with profiling.span('intersection'):
+                    masked_probs[:, overlapping[vol_pos]] += np.dot(
+                                            weights[sel].T, chunk[chunk_idx])
+            return
+
+        prob_vol = self.get_prob_volume()
+        vox_idx = tuple(idx[:, np.newaxis] for idx in atlas_idx)
+        with profiling.span('intersection'):
+            masked_probs[:, overlapping] += np.dot(weights.T,
+                                         prob_vol[vox_idx + (overlapping,)])
+
+
+    def query_mask_table(self, mask_img, measure='avgprob'):
+        '''
+        Calculates measure for every volume of mask_img and every structure
+        of the atlas in one pass: mask_img is resampled to the atlas voxels
+        once, or one slab at a time within a memory budget, and the
+        probabilities of all structures are weighted by all the mask volumes
+        with one matrix product.
+
+        Parameters
+        ----------
+        mask_img: nib.Nifti1Image or nipy Image
+        3D or 4D mask.
+
+        measure: string
+        'avgprob' for the average probability of the atlas voxels in the mask
+        or 'roiover' for the ROI overlap percentage.
+
+        Returns
+        -------
+        (n_volumes, n_structures) array, with one row for 3D masks
+        '''
+        if measure not in ('avgprob', 'roiover'):
+            raise ValueError('Unknown measure ' + str(measure))
+
+        n_vols = get_num_mask_volumes(mask_img) or 1
 
-        prob_vol = self.image.get_data()[:, :, :, struct_idx]
+        masked_probs = np.zeros((n_vols, self.image.shape[3]))
+        mask_sums = 0
+        for atlas_idx, weights, slab_sums in self.iter_mask_voxels(mask_img):
+            mask_sums = mask_sums + slab_sums
 
-        prob_sum = np.sum(prob_vol)
+            if len(weights):
+                weights = weights.reshape((len(weights), n_vols))
+                self._add_masked_probs(masked_probs, atlas_idx,
+                                       weights.astype(float))
 
-        masked_probs = self._get_roi_mask_intersect(mask_img, struct_idx)
+        if measure == 'avgprob':
+            norm = np.reshape(mask_sums, (-1, 1))
+        else:
+            norm = self.get_structure_stats().mass[np.newaxis, :]
+
+        return _divide(masked_probs, norm)
+
+
+    def get_cluster_sums(self, cluster_img, n_clusters):
+        '''
+        Returns the (n_clusters, n_structures) table with the sum of the
+        probabilities of every structure over the voxels of every cluster.
+        The cluster voxels are resampled to the atlas once and the sums of
+        all clusters come from one sparse matrix product.
+
+        Parameters
+        ----------
+        cluster_img: nib.Nifti1Image
+        See query_cluster_table.
+
+        n_clusters: int
+        '''
+        from scipy import sparse
+
+        atlas_idx, clusters = mask_to_atlas_voxels(cluster_img,
+                                                   self.get_geometry())
+
+        cluster_sums = np.zeros((n_clusters, self.image.shape[3]))
+        if not len(clusters):
+            return cluster_sums
+
+        bbox_min, bbox_max = get_voxels_bbox(atlas_idx)
+        overlapping = self.get_structure_stats().find_overlapping(bbox_min,
+                                                                  bbox_max)
+
+        n_vox = len(clusters)
+        membership = sparse.csc_matrix((np.ones(n_vox),
+                                        (clusters.astype(int) - 1,
+                                         np.arange(n_vox))),
+                                       shape=(n_clusters, n_vox))
+
+        if self._reads_chunks():
+            # accumulated one chunk of atlas data at a time
+            chunks = iter_chunks(self.image.dataobj, bbox_min, bbox_max,
+                                 self.memory_budget, overlapping)
+            for offset, vol_pos, chunk in chunks:
+                sel, chunk_idx = get_chunk_voxels(atlas_idx, offset,
+                                                  chunk.shape)
+                with profiling.span('intersection'):
+                    probs = chunk[chunk_idx].astype(float)
+                    cluster_sums[:, overlapping[vol_pos]] += \
+                                            membership[:, sel].dot(probs)
+
+            return cluster_sums
 
-        return masked_probs/prob_sum if prob_sum > 0 else 0
+        prob_vol = self.get_prob_volume()
+        vox_idx = tuple(idx[:, np.newaxis] for idx in atlas_idx)
+        with profiling.span('intersection'):
+            probs = prob_vol[vox_idx + (overlapping,)].astype(float)
+            cluster_sums[:, overlapping] = membership.dot(probs)
 
+        return cluster_sums
 
-    def get_description(self, x, y, z):
+
+    def get_description(self, x, y, z, threshold=None):
         '''
         Returns the label corresponding to the given coordinates
         Parameters
@@ -289,6 +1262,12 @@ class StatsAtlas (Atlas):
         x, y, z: int
         Coordinates in mm of the point of interest.
 
+        threshold: float
+        If given, only the structure with the highest probability is
+        described, if its probability is above threshold, see
+        get_max_structures. Otherwise all the structures at the coordinate
+        are described.
+
         Returns
         -------
         string
@@ -306,23 +1285,27 @@ class StatsAtlas (Atlas):
 
         return text
         '''
-        i, j, k = mm_to_voxcoord(self.image, x, y, z)
+        i, j, k = self._get_voxel_index(x, y, z)
 
         precision = 10**self.precision
-        n_vols = self.image.shape[3]
-
-        labels = {}
-        for v in xrange(n_vols):
-            vol = self.image.get_data()[:, :, :, v]
 
-            try:
-                stat = vol[i, j, k]
-            except:
-                stat = 0
+        labels = []
+        if not is_valid_coordinate(self.image, i, j, k):
+            pass
 
-            if round(stat * precision) != 0:
-                if self.find_label(v) is not None:
-                    labels.append((stat, self.find_label(v)))
+        else:
+            if threshold is not None:
+                structs, stats = self.get_max_structures([(x, y, z)],
+                                                         threshold)
+                structs, stats = structs[structs >= 0], stats[structs >= 0]
+            else:
+                structs, stats = self._lookup_voxel(i, j, k)
+
+            for v, stat in zip(structs, stats):
+                if round(stat * precision) != 0:
+                    label = self.find_label(v)
+                    if label is not None:
+                        labels.append((stat, label))
 
         count = 0
         text = self.name + '\n'
@@ -333,10 +1316,10 @@ class StatsAtlas (Atlas):
 
             if count:
                 text += ', '
+            count += 1
 
-            prec10 = 10**self.precision
-            stat = round(stat, prec10)
-            text += "%.*f" % (prec10, stat)
+            stat = round(stat, self.precision)
+            text += "%.*f" % (self.precision, stat)
 
             if self.stats_name:
                 text += self.stats_name + '='
@@ -369,6 +1352,151 @@ class LabelAtlas (Atlas):
         self.type = 'label'
 
 
+    def load_data(self):
+        '''
+        Loads the data of self.image and its per-structure stats, so later
+        queries, and worker processes forked afterwards, find them ready.
+        '''
+        Atlas.load_data(self)
+        self.get_structure_stats()
+
+
+    def compute_structure_stats(self):
+        '''
+        Returns the StructureStats of self.image, indexed by label value
+        '''
+        n_labels = self.labels.get_max_index() + 1
+
+        if self._reads_chunks():
+            lab_vol = self.image.dataobj
+            volume = 0 if len(lab_vol.shape) == 4 else None
+            return compute_label_stats(lab_vol, n_labels, self.memory_budget,
+                                       volume)
+
+        return compute_label_stats(self.get_label_volume(), n_labels)
+
+
+    def get_label_volume(self):
+        '''
+        Returns the 3D volume of structure labels of self.image
+        '''
+        lab_vol = self.get_data()
+        if lab_vol.ndim == 4:
+            lab_vol = lab_vol[:, :, :, 0]
+
+        return lab_vol
+
+
+    def _read_labels(self, vox_idx):
+        '''
+        Returns the label values at the voxels vox_idx, read in chunks if
+        there is a memory budget.
+
+        Parameters
+        ----------
+        vox_idx: tuple of three int arrays
+        Voxel indices.
+
+        Returns
+        -------
+        (N, ) array
+        '''
+        if not self._reads_chunks():
+            return self.get_label_volume()[vox_idx]
+
+        if len(self.image.shape) == 4:
+            return read_voxel_values(self.image.dataobj, vox_idx,
+                                     self.memory_budget, [0])[:, 0]
+
+        return read_voxel_values(self.image.dataobj, vox_idx,
+                                 self.memory_budget)
+
+
+    def _label_bincount(self, labs, weights=None):
+        '''
+        Returns np.bincount of the label values in labs, ignoring negative
+        labels. The result has at least one bin per structure label.
+
+        Parameters
+        ----------
+        labs: numpy array of label values
+
+        weights: numpy array of the same size as labs, optional
+        It can also be a (len(labs), n_volumes) matrix of the weights of
+        several volumes.
+
+        Returns
+        -------
+        numpy array indexed by label value, with one column per volume for
+        weight matrices
+        '''
+        labs = np.asarray(labs).ravel().astype(int)
+        keep = labs >= 0
+
+        n_bins = self.labels.get_max_index() + 1
+
+        if weights is None or np.ndim(weights) == 1:
+            if weights is not None:
+                weights = np.asarray(weights, dtype=float).ravel()[keep]
+
+            return np.bincount(labs[keep], weights=weights, minlength=n_bins)
+
+        # one bincount for all the volumes, with a bin per label and volume
+        weights = np.asarray(weights, dtype=float)[keep]
+        n_vols = weights.shape[1]
+
+        bins = labs[keep][:, np.newaxis] * n_vols + np.arange(n_vols)
+        sums = np.bincount(bins.ravel(), weights=weights.ravel(),
+                           minlength=n_bins * n_vols)
+
+        return sums.reshape((-1, n_vols))
+
+
+    def get_label_counts(self):
+        '''
+        Returns the number of voxels of every label of self.image, indexed
+        by label value, see get_structure_stats.
+        '''
+        return self.get_structure_stats().n_voxels
+
+
+    def _get_masked_label_sums(self, mask_img):
+        '''
+        Returns the sum of the mask_img values that fall on each label of
+        self.image, see get_masked_label_sums, and the sum of all the
+        mask_img values, see mask_intersect.get_mask_sums.
+        '''
+        label_sums = None
+        mask_sums = 0
+        for atlas_idx, weights, slab_sums in self.iter_mask_voxels(mask_img):
+            mask_sums = mask_sums + slab_sums
+
+            labs = self._read_labels(atlas_idx)
+
+            with profiling.span('intersection'):
+                label_sums = _add_padded(label_sums,
+                                         self._label_bincount(labs, weights))
+
+        return label_sums, mask_sums
+
+
+    def get_masked_label_sums(self, mask_img):
+        '''
+        Returns the sum of the mask_img values that fall on each label of
+        self.image, indexed by label value.
+
+        Parameters
+        ----------
+        mask_img: nib.Nifti1Image or nipy Image
+        3D or 4D mask.
+
+        Returns
+        -------
+        numpy array of floats, with one column per volume for 4D masks
+        '''
+        return self._get_masked_label_sums(mask_img)[0]
+
+
     def get_probability(self, structure, x, y, z):
         '''
         Parameters
@@ -383,11 +1511,69 @@ class LabelAtlas (Atlas):
         -------
         int: 100 if the coordinate corresponds to the given structure, 0 if not
         '''
-        i, j, k = mm_to_voxcoord(self.img, x, y, z)
+        i, j, k = self._get_voxel_index(x, y, z)
+
+        if not is_valid_coordinate(self.image, i, j, k):
+            return 0
+
+        lab = self._read_labels(([i], [j], [k]))[0]
+
+        return 100 if lab == structure else 0
+
+
+    def labels_at(self, coords):
+        '''
+        Returns the label value at each of the mm coordinates in coords, -1
+        for the coordinates outside of the atlas.
+
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
+
+        Returns
+        -------
+        (N, ) int array
+        '''
+        vox_idx, inside = self.coords_to_voxels(coords)
+
+        labs = -np.ones(len(inside), dtype=int)
+        labs[inside] = self._read_labels(tuple(vox_idx[inside].T))
+
+        return labs
+
+
+    def probabilities_at(self, coords, struct_idx=None):
+        '''
+        Returns the probability values of every structure at each of the mm
+        coordinates in coords: 100 for the structure labelled there and 0
+        for the rest.
+
+        Parameters
+        ----------
+        coords: (N, 3) array of mm coordinates
+
+        struct_idx: int
+        Index of the atlas' structure of interest. If given, only the
+        probabilities of this structure are returned.
+
+        Returns
+        -------
+        (N, n_structures) array, or (N, ) array if struct_idx is given.
+        Structure columns are indexed by label value.
+        '''
+        labs = self.labels_at(coords)
+
+        if struct_idx is not None:
+            return 100 * (labs == struct_idx)
 
-        vol = self.get_volume(0).get_data()
+        n_structs = self.labels.get_max_index() + 1
+        n_structs = max(n_structs, np.max(labs) + 1 if len(labs) else 0)
 
-        return 100 if vol[i, j, k] == structure else 0
+        probs = np.zeros((len(labs), n_structs), dtype=int)
+        found = np.flatnonzero(labs >= 0)
+        probs[found, labs[found]] = 100
+
+        return probs
 
 
     def _get_roi_mask_intersect(self, mask_img, struct_idx):
@@ -400,27 +1586,33 @@ class LabelAtlas (Atlas):
 
         Returns
         -------
-        The total sum of 
+        masked_probs:
+        The total sum of the mask values in the structure, times 100, an
+        array with one sum per volume for 4D masks.
 
+        mask_sums:
+        The sum of the mask values, see mask_intersect.get_mask_sums.
         '''
-        mask_vol = np.array(mask_img.get_data())
+        stats = self.get_structure_stats()
 
-        if self.image.shape[3] <= struct_idx:
-            return 0
+        masked_probs = get_zero_values(mask_img)
+        mask_sums = 0.
+        for atlas_idx, weights, slab_sums in self.iter_mask_voxels(mask_img):
+            mask_sums = mask_sums + slab_sums
 
-        lab_img = nifti2nipy(self.image)
-        lab_vol = lab_img[:, :, :, struct_idx]
+            if not len(weights):
+                continue
 
-        masked_probs = 0.0
+            overlapping = stats.find_overlapping(*get_voxels_bbox(atlas_idx))
+            if struct_idx not in overlapping:
+                continue
 
-        mask_cm = get_3D_coordmap(mask_img)
-        lab_cm = get_3D_coordmap(lab_img)
-        for idx in np.argwhere(mask_vol):
-            voxc = mm_to_voxcoord(lab_cm, *voxcoord_to_mm(mask_cm, *idx))
-            prob = 100 if lab_vol[tuple(voxc)] == struct_idx else 0
-            masked_probs += prob * mask_vol[tuple(idx)]
+            with profiling.span('intersection'):
+                in_struct = self._read_labels(atlas_idx) == struct_idx
+                masked_probs = masked_probs + 100 * np.sum(
+                                weights[in_struct].astype(float), axis=0)
 
-        return masked_probs
+        return masked_probs, mask_sums
 
 
     def get_avg_probability(self, mask_img, struct_idx):
@@ -431,26 +1623,23 @@ class LabelAtlas (Atlas):
         Parameters
         ----------
         mask_img: nib.Nifti1Image
+        3D or 4D mask.
 
         struct_idx: int
         Index of the atlas' structure of interest.
 
         Returns
         -------
-        float number of the resulting average probability
+        float number of the resulting average probability, or array with
+        the average probability of each volume for 4D masks
         '''
-        mask_img = nifti2nipy(mask_img)
-        mask_vol = mask_img.get_data()
-
-        if self.image.shape[3] <= struct_idx:
-            return 0
+        if len(self.get_structure_stats()) <= struct_idx or struct_idx < 0:
+            return get_zero_values(mask_img)
 
-        lab_vol = self.image.get_data()
+        masked_probs, mask_sum = self._get_roi_mask_intersect(mask_img,
+                                                              struct_idx)
 
-        mask_sum = np.sum(mask_vol)
-        masked_probs = self._get_roi_mask_intersect(mask_img, struct_idx)
-
-        return masked_probs/mask_sum if mask_sum > 0 else 0
+        return _divide(masked_probs, mask_sum)
 
 
     def get_roi_overlap(self, mask_img, struct_idx):
@@ -461,29 +1650,105 @@ class LabelAtlas (Atlas):
         Parameters
         ----------
         mask_img: nib.Nifti1Image
+        3D or 4D mask.
 
         struct_idx: int
         Index of the atlas' structure of interest.
 
         Returns
         -------
-        float number of the resulting ROI overlap percentage
+        float number of the resulting ROI overlap percentage, or array with
+        the overlap of each volume for 4D masks
         '''
-        mask_vol = mask_img.get_data()
-
-        if self.image.shape[3] <= struct_idx:
-            return 0
+        lab_counts = self.get_label_counts()
+        if len(lab_counts) <= struct_idx or struct_idx < 0:
+            return get_zero_values(mask_img)
 
-        lab_vol = self.image.get_data()
-        lab_sum = np.sum(lab_vol == struct_idx)
+        lab_sum = lab_counts[struct_idx]
 
-        masked_probs = self._get_roi_mask_intersect(mask_img, struct_idx)
+        masked_probs = self._get_roi_mask_intersect(mask_img, struct_idx)[0]
         masked_probs /= 100
 
-        return masked_probs/lab_sum if lab_sum > 0 else 0
+        return _divide(masked_probs, lab_sum)
+
+
+    def query_mask_table(self, mask_img, measure='avgprob'):
+        '''
+        Calculates measure for every volume of mask_img and every structure
+        of the atlas in one pass: mask_img is resampled to the atlas voxels
+        once and the mask values under every label are summed for all the
+        volumes with one bincount.
+
+        Parameters
+        ----------
+        mask_img: nib.Nifti1Image or nipy Image
+        3D or 4D mask.
+
+        measure: string
+        'avgprob' for the average probability of the atlas voxels in the mask
+        or 'roiover' for the ROI overlap percentage.
+
+        Returns
+        -------
+        (n_volumes, n_structures) array, with one row for 3D masks.
+        Structure columns are indexed by label value.
+        '''
+        if measure not in ('avgprob', 'roiover'):
+            raise ValueError('Unknown measure ' + str(measure))
+
+        n_vols = get_num_mask_volumes(mask_img) or 1
+
+        label_sums, mask_sums = self._get_masked_label_sums(mask_img)
+        label_sums = label_sums.reshape((len(label_sums), n_vols)).T
+
+        if measure == 'avgprob':
+            norm = np.reshape(mask_sums, (-1, 1))
+            return _divide(100 * label_sums, norm)
+
+        lab_counts = self.get_label_counts()
+
+        norm = np.zeros(label_sums.shape[1])
+        n_labs = min(len(norm), len(lab_counts))
+        norm[:n_labs] = lab_counts[:n_labs]
+
+        return _divide(label_sums, norm[np.newaxis, :])
 
 
-    def get_description(self, x, y, z):
+    def get_cluster_sums(self, cluster_img, n_clusters):
+        '''
+        Returns the (n_clusters, n_structures) table with the sum of the
+        probabilities, 100 for every labelled voxel, of every structure over
+        the voxels of every cluster. The cluster voxels are resampled to the
+        atlas once and counted with one bincount over (cluster, label) bins.
+        Structure columns are indexed by label value.
+
+        Parameters
+        ----------
+        cluster_img: nib.Nifti1Image
+        See query_cluster_table.
+
+        n_clusters: int
+        '''
+        atlas_idx, clusters = mask_to_atlas_voxels(cluster_img,
+                                                   self.get_geometry())
+
+        labs = self._read_labels(atlas_idx).astype(int)
+        keep = labs >= 0
+        labs = labs[keep]
+        clusters = clusters[keep].astype(int) - 1
+
+        n_labs = self.labels.get_max_index() + 1
+        if len(labs):
+            n_labs = max(n_labs, labs.max() + 1)
+
+        with profiling.span('intersection'):
+            bins = clusters * n_labs + labs
+            counts = np.bincount(bins, minlength=n_clusters * n_labs)
+
+        return 100. * counts.reshape((n_clusters, n_labs))
+
+
+    def get_description(self, x, y, z, threshold=None):
         '''
         Returns the label corresponding to the given coordinates
         Parameters
@@ -491,19 +1756,22 @@ class LabelAtlas (Atlas):
         x, y, z: int
         Coordinates in mm of the point of interest.
 
+        threshold: float
+        Not used, label atlases have a single structure at each voxel.
+
         Returns
         -------
         string
         '''
-        i, j, k = mm_to_voxcoord(self.image, x, y, z)
+        i, j, k = self._get_voxel_index(x, y, z)
 
         if is_valid_coordinate(self.image, i, j, k):
-            index = self.image.get_data()[i, j, k]
+            index = self._read_labels(([i], [j], [k]))[0]
         else:
             index = 0
 
         text = self.name + '\n'
-        if self.labels.has_key(index):
+        if index in self.labels:
             text += self.labels[index]
 
         return text
@@ -0,0 +1,279 @@
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+import profiling
+
+
+def get_cache_dir():
+    '''
+    Returns the directory where atlasquerpy keeps its cache files.
+    It is $ATLASQUERPY_CACHE_DIR if set, otherwise the atlasquerpy folder
+    inside $XDG_CACHE_HOME or ~/.cache.
+    '''
+    if os.environ.get('ATLASQUERPY_CACHE_DIR', ''):
+        return os.environ['ATLASQUERPY_CACHE_DIR']
+
+    cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(cache_home, 'atlasquerpy')
+
+
+def get_file_signature(file_path):
+    '''
+    Returns a (mtime, size) pair identifying the current version of
+    file_path.
+    '''
+    st = os.stat(file_path)
+    return [st.st_mtime, st.st_size]
+
+
+def get_cache_key(file_path):
+    '''
+    Returns a file name safe key for file_path
+    '''
+    abs_path = os.path.abspath(file_path)
+    return hashlib.sha1(abs_path.encode('utf-8')).hexdigest()
+
+
+def write_atomic(file_path, write, mode='w'):
+    '''
+    Writes file_path through a temporary file in the same directory, so
+    concurrent readers never see a partial file.
+
+    Parameters
+    ----------
+    file_path: string
+
+    write: function
+    Called with the opened temporary file to write its content.
+
+    mode: string
+    Mode to open the temporary file with.
+    '''
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        try:
+            os.makedirs(dir_path)
+        except OSError:
+            # created meanwhile by another thread or process
+            if not os.path.isdir(dir_path):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.rename(tmp_path, file_path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class MetadataCache:
+    '''
+    On-disk cache of the metadata parsed from atlas XML files.
+    Entries are keyed on the XML path and are invalidated when the mtime or
+    the size of the XML file change, or of any of the files the metadata
+    was derived from, like the atlas images, or when they were written with
+    another metadata format version.
+    '''
+
+    format_version = 3
+
+    def __init__(self, cache_dir=None):
+        '''
+        Parameters
+        ----------
+        cache_dir: string
+        Cache directory, get_cache_dir() by default.
+        '''
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+
+        self.cache_dir = os.path.join(cache_dir, 'metadata')
+
+
+    def _get_entry_path(self, xml_path):
+        '''
+        '''
+        return os.path.join(self.cache_dir, get_cache_key(xml_path) + '.json')
+
+
+    def get(self, xml_path):
+        '''
+        Returns the cached metadata of xml_path, or None if there is no
+        valid entry for the current version of the file.
+
+        Parameters
+        ----------
+        xml_path: string
+
+        Returns
+        -------
+        dict or None
+        '''
+        try:
+            with open(self._get_entry_path(xml_path)) as f:
+                entry = json.load(f)
+
+            if entry.get('version') != self.format_version:
+                return None
+
+            if entry['signature'] != get_file_signature(xml_path):
+                return None
+
+            for dep_path, signature in entry['dependencies']:
+                if signature != get_file_signature(dep_path):
+                    return None
+
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+        return entry['metadata']
+
+
+    def put(self, xml_path, metadata, dependencies=()):
+        '''
+        Stores metadata as the cache entry of xml_path.
+        Problems writing the cache are ignored, it will be rebuilt next time.
+
+        Parameters
+        ----------
+        xml_path: string
+
+        metadata: dict
+        JSON serializable atlas metadata
+
+        dependencies: list of strings
+        Paths of other files the metadata depends on, the entry is
+        invalidated when any of them changes.
+        '''
+        try:
+            entry = {'xml_path': os.path.abspath(xml_path),
+                     'version': self.format_version,
+                     'signature': get_file_signature(xml_path),
+                     'dependencies': [[dep_path, get_file_signature(dep_path)]
+                                      for dep_path in dependencies],
+                     'metadata': metadata}
+
+            write_atomic(self._get_entry_path(xml_path),
+                         lambda f: json.dump(entry, f))
+
+        except (IOError, OSError):
+            pass
+
+
+class VolumeCache:
+    '''
+    On-disk cache of decompressed atlas volumes.
+    The data of each compressed atlas image is decompressed once into an
+    uncompressed .npy file, which later loads map with np.memmap, so the
+    data is not copied and processes share it through the OS page cache.
+    Entries are keyed on the image path, mtime and size, and writing the
+    entry of a new version of an image removes the entries of its previous
+    versions.
+    '''
+
+    def __init__(self, cache_dir=None):
+        '''
+        Parameters
+        ----------
+        cache_dir: string
+        Cache directory, get_cache_dir() by default.
+        '''
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+
+        self.cache_dir = os.path.join(cache_dir, 'volumes')
+
+
+    def _get_entry_prefix(self, img_file):
+        '''
+        Returns the file name prefix of all the entries of img_file
+        '''
+        return get_cache_key(img_file) + '-'
+
+
+    def _get_entry_path(self, img_file):
+        '''
+        '''
+        signature = get_file_signature(img_file)
+        version = get_cache_key('%r:%d' % (signature[0], signature[1]))
+
+        entry_name = self._get_entry_prefix(img_file) + version + '.npy'
+
+        return os.path.join(self.cache_dir, entry_name)
+
+
+    def _remove_stale_entries(self, img_file, entry_path):
+        '''
+        Removes the entries of img_file other than entry_path, left by
+        previous versions of the file. Processes that still map them keep
+        their data until they unmap it.
+        '''
+        prefix = self._get_entry_prefix(img_file)
+
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+
+        for name in names:
+            file_path = os.path.join(self.cache_dir, name)
+            if (name.startswith(prefix) and name.endswith('.npy') and
+                file_path != entry_path):
+                try:
+                    os.remove(file_path)
+                    profiling.count('volume_cache_stale_removed')
+                except OSError:
+                    pass
+
+
+    def load(self, img_file):
+        '''
+        Returns the image in img_file with its data backed by a np.memmap of
+        the decompressed volume, creating the cache entry if needed.
+        Uncompressed images are loaded directly with nibabel.
+
+        Parameters
+        ----------
+        img_file: string
+
+        Returns
+        -------
+        nib.Nifti1Image
+        '''
+        img = nib.load(img_file)
+
+        if not img_file.endswith('.gz'):
+            return img
+
+        entry_path = self._get_entry_path(img_file)
+
+        if not os.path.exists(entry_path):
+            profiling.count('volume_cache_misses')
+            with profiling.span('volume_cache_write'):
+                vol = img.get_data()
+                try:
+                    write_atomic(entry_path, lambda f: np.save(f, vol), 'wb')
+                except (IOError, OSError):
+                    return img
+
+            self._remove_stale_entries(img_file, entry_path)
+        else:
+            profiling.count('volume_cache_hits')
+
+        try:
+            vol = np.load(entry_path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return img
+
+        return nib.Nifti1Image(vol, img.get_affine(), img.get_header())
@@ -1,19 +1,99 @@
 
 import os
+import multiprocessing
+from array import array
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 import nibabel as nib
+import profiling
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
 from atlas import Atlas, StatsAtlas, LabelAtlas
+from atlas_cache import MetadataCache, VolumeCache
+from label_table import create_label_table, label_table_from_dict
+
+
+def map_threads(func, items, n_threads=None):
+    '''
+    Returns [func(item) for item in items], computed in a pool of threads.
+    File reads and gzip decompression release the GIL, so atlas files are
+    read concurrently.
+
+    Parameters
+    ----------
+    func: function
+
+    items: iterable
+
+    n_threads: int
+    Number of threads, the number of CPUs by default. With 1 thread, or a
+    single item, func is called in the current thread.
+
+    Returns
+    -------
+    list
+    '''
+    items = list(items)
+
+    if n_threads == 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+
+    pool = ThreadPool(min(n_threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class AtlasFiles:
 
+    header_keys = ('name', 'type', 'lower', 'upper', 'precision',
+                   'stats_name', 'units')
+
 
-    def __init__(self):
+    def __init__(self, use_cache=True, volume_cache=False, compact=False,
+                 memory_budget=None, n_threads=None):
         '''
+        Parameters
+        ----------
+        use_cache: boolean
+        True to keep the parsed atlas XML files in the on-disk
+        MetadataCache, False to always read the XML files.
+
+        volume_cache: boolean
+        True to load the atlas images through the on-disk VolumeCache of
+        decompressed volumes, False to load them directly with nibabel.
+
+        compact: boolean
+        True to keep the probability volumes of the atlases quantized in
+        memory, see StatsAtlas.set_compact.
+
+        memory_budget: int
+        Maximum number of bytes of atlas data read at once by the queries,
+        see Atlas.set_memory_budget. None to load the whole atlas volumes.
+
+        n_threads: int
+        Number of threads that open the images of an atlas through the
+        volume cache, see map_threads and create_atlas.
         '''
         self.fsl_dir = ''
         self.mni = ''
         self.atlas_path = ''
 
+        self.metadata_cache = MetadataCache() if use_cache else None
+        self.volume_cache = VolumeCache() if volume_cache else None
+        self.compact = compact
+        self.memory_budget = memory_budget
+        self.n_threads = n_threads
+
 
     def get_FSL_dir(self):
         '''
@@ -87,27 +167,27 @@ class AtlasFiles:
         return o
 
 
-    def read_image(self, atlas_dir, images_node, tag):
+    def find_image_file(self, atlas_dir, images_node, tag):
         '''
         Looks for an Element node between images_node children with name tag.
-        This element will hold a relative path to an atlas volume file, which
-        will be opened and returned as nib.Nifti1Image.
+        This element will hold a relative path to an atlas volume file, whose
+        full path is returned.
 
         Parameters
         ----------
         atlas_dir: string
 
-        images_node: xml dom node
+        images_node: ElementTree element
 
         tag: string
 
         Returns
         -------
-        nib.Nifti1Image
+        string
         '''
-        for node in images_node.childNodes:
-            if node.nodeType == node.ELEMENT_NODE and node.nodeName == tag:
-                node_text = str(node.firstChild.data)
+        for node in images_node:
+            if node.tag == tag:
+                node_text = node.text.strip() if node.text else ''
                 if node_text:
                     full_atlas_dir = os.path.join(atlas_dir, os.path.dirname(node_text)[1:])
 
@@ -115,24 +195,96 @@ class AtlasFiles:
 
                     full_file = self.find(os.listdir(full_atlas_dir), file_base_name)[0]
 
-                    img = nib.load(os.path.join(full_atlas_dir, full_file))
+                    img_file = os.path.join(full_atlas_dir, full_file)
 
-        return img
+        return img_file
 
 
-    def _get_dom_attribute_value(self,node, att_name, alt=''):
+    def read_image(self, atlas_dir, images_node, tag):
         '''
+        Looks for an Element node between images_node children with name tag.
+        This element will hold a relative path to an atlas volume file, which
+        will be opened and returned as nib.Nifti1Image.
+
+        Parameters
+        ----------
+        atlas_dir: string
+
+        images_node: ElementTree element
+
+        tag: string
+
+        Returns
+        -------
+        nib.Nifti1Image
         '''
-        if node.attributes.has_key(att_name):
-            return node.attributes[att_name].value
-        else:
-            return alt
+        return nib.load(self.find_image_file(atlas_dir, images_node, tag))
 
 
-    def read_xml_atlas(self, atlas_dir, file_name):
+    def get_default_header(self):
         '''
-        Process the data inside an Atlas definition XML file and returns the 
-        corresponding Atlas.
+        Returns the header values of an atlas whose XML file does not set
+        them.
+        '''
+        return {'name': '', 'type': None, 'lower': -100, 'upper': 100,
+                'precision': 0, 'stats_name': '', 'units': ''}
+
+
+    def _read_header_element(self, header, elem):
+        '''
+        Sets in header the value given by elem, if it is one of the
+        elements of an atlas XML header.
+
+        Parameters
+        ----------
+        header: dict, see get_default_header
+
+        elem: ElementTree element
+        '''
+        tag = elem.tag
+        node_text = elem.text.strip() if elem.text else ''
+
+        if not node_text:
+            return
+
+        if tag == 'name':
+            header['name'] = str(node_text)
+
+        elif tag == 'units':
+            header['units'] = str(node_text)
+
+        elif tag == 'precision':
+            header['precision'] = int(node_text)
+
+        elif tag == 'upper':
+            header['upper'] = float(node_text)
+
+        elif tag == 'lower':
+            header['lower'] = float(node_text)
+
+        elif tag == 'statistic':
+            header['stats_name'] = str(node_text)
+
+        elif tag == 'type':
+            if node_text.lower() == 'label':
+                header['type'] = 'label'
+            elif node_text.lower() == 'probabilistic':
+                header['type'] = 'probs'
+                header['units'] = '%'
+                header['lower'] = 0
+                header['upper'] = 100
+                header['precision'] = 0
+            else:
+                header['type'] = 'probs'
+
+
+    def read_xml_header(self, atlas_dir, file_name):
+        '''
+        Reads only the header of an Atlas definition XML file. The file is
+        parsed incrementally and parsing stops at the end of the header, so
+        neither the label table nor the atlas images are read.
+        If the metadata cache is in use, the header is taken from the cached
+        metadata of the file instead, which are created if missing.
 
         Parameters
         ----------
@@ -142,127 +294,234 @@ class AtlasFiles:
 
         Returns
         -------
-        Atlas
+        dict with the header values: 'name', 'type', 'lower', 'upper',
+        'precision', 'stats_name' and 'units', plus the 'atlas_dir' and
+        'file_name' of the XML file.
+        '''
+        full_path = os.path.join(atlas_dir, file_name)
 
+        if self.metadata_cache is not None:
+            metadata = self.get_xml_metadata(atlas_dir, file_name)
+            header = dict((k, metadata[k]) for k in self.header_keys)
+            header['name'] = str(header['name'])
+            header['atlas_dir'] = atlas_dir
+            header['file_name'] = file_name
+            return header
+
+        header = self.get_default_header()
+        header['atlas_dir'] = atlas_dir
+        header['file_name'] = file_name
+
+        try:
+            xml_file = open(full_path)
+        except IOError:
+            print ("Error: can\'t find file or read " + full_path)
+
+            raise
+
+        with xml_file, profiling.span('xml_header_parse'):
+            for event, elem in ElementTree.iterparse(xml_file):
+                if elem.tag == 'header':
+                    break
+
+                self._read_header_element(header, elem)
+
+        return header
+
+
+    def read_xml_metadata(self, atlas_dir, file_name):
         '''
-        from xml.dom import minidom
+        Process the data inside an Atlas definition XML file and returns the
+        atlas metadata, without opening any atlas image.
+        The file is parsed in one streaming pass and the label elements are
+        discarded as soon as they are read, so the labels are collected in
+        compact arrays instead of a document tree.
+
+        Parameters
+        ----------
+        atlas_dir: string
+
+        file_name: string
+
+        Returns
+        -------
+        dict with the header values: 'name', 'type', 'lower', 'upper',
+        'precision', 'stats_name' and 'units'; the full paths of the atlas
+        'images' and 'summaries'; and the 'labels' as the dict of a
+        LabelTable with the label indices, names and centres, see
+        LabelTable.to_dict.
 
+        '''
         full_path = os.path.join(atlas_dir, file_name)
 
         try:
-            dom = minidom.parse(full_path)
+            xml_file = open(full_path)
         except IOError:
             print ("Error: can\'t find file or read " + full_path)
-            
+
             raise
 
-        root = dom.documentElement
-
-        atlas_name = ''
-        atlas_type = None
-        atlas_images = []
-        atlas_summaries = []
-        lower = -100
-        upper = 100
-        precision = 0
-        stats_name = ''
-        units = ''
-
-        for node in root.childNodes:
-
-            if node.nodeType == node.ELEMENT_NODE:
-                node_name = node.nodeName
-                if node_name == 'header':
-                    for curr_node in node.childNodes:
-
-                        if curr_node.nodeType == node.ELEMENT_NODE:
-                            curr_node_name = curr_node.nodeName
-
-                            if curr_node_name == 'name':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    atlas_name = node_text
-
-                            elif curr_node_name == 'units':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    units = node_text
-
-                            elif curr_node_name == 'precision':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    precision = int(node_text)
-
-                            elif curr_node_name == 'upper':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    upper = float(node_text)
-
-                            elif curr_node_name == 'lower':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    lower = float(node_text)
-
-                            elif curr_node_name == 'statistic':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    stats_name = node_text
-
-                            elif curr_node_name == 'type':
-                                node_text = str(curr_node.firstChild.data)
-                                if node_text:
-                                    if node_text.lower() == 'label':
-                                        atlas_type = 'label'
-                                    elif node_text.lower() == 'probabilistic':
-                                        atlas_type = 'probs'
-                                        units = '%'
-                                        lower = 0
-                                        upper = 100
-                                        precision = 0
-
-                                    else:
-                                        atlas_type = 'probs'
-
-                            elif curr_node_name == 'images':
-                                atlas_images.append(self.read_image(atlas_dir,
-                                                                    curr_node,
-                                                                    'imagefile'))
-
-                                atlas_summaries.append(self.read_image(atlas_dir,
-                                                                       curr_node,
-                                                                       'summaryimagefile'))
-
-        if atlas_type == 'probs':
-            atlas = StatsAtlas(atlas_images, atlas_summaries, atlas_name,
-                               lower, upper, precision, stats_name, units)
+        metadata = self.get_default_header()
+        metadata['images'] = []
+        metadata['summaries'] = []
 
-        elif atlas_type == 'label':
-            atlas = LabelAtlas(atlas_images, atlas_summaries, atlas_name)
+        indices = array('l')
+        centres = array('l')
+        names = []
+
+        with xml_file, profiling.span('xml_parse'):
+            for event, elem in ElementTree.iterparse(xml_file):
+                tag = elem.tag
+
+                if tag == 'label':
+                    indices.append(int(elem.get('index', '0')))
+                    names.append(str(elem.text or ''))
+                    centres.extend([int(elem.get(c, '0')) for c in 'xyzv'])
+                    elem.clear()
+
+                elif tag == 'images':
+                    metadata['images'].append(
+                        self.find_image_file(atlas_dir, elem, 'imagefile'))
+                    metadata['summaries'].append(
+                        self.find_image_file(atlas_dir, elem,
+                                             'summaryimagefile'))
+
+                elif tag in self.header_keys or tag == 'statistic':
+                    self._read_header_element(metadata, elem)
+
+        label_table = create_label_table(np.array(indices, dtype=np.int64),
+                                         names,
+                                         np.array(centres, dtype=np.int32))
+        profiling.count('atlas_labels', len(label_table))
+
+        metadata['labels'] = label_table.to_dict()
+
+        return metadata
+
+
+    def get_xml_metadata(self, atlas_dir, file_name):
+        '''
+        Returns the metadata of an Atlas definition XML file, from the
+        metadata cache if it holds an entry for the current version of the
+        file and of its atlas images, or reading the XML file otherwise.
+
+        Parameters
+        ----------
+        atlas_dir: string
+
+        file_name: string
+
+        Returns
+        -------
+        dict, see read_xml_metadata
+        '''
+        full_path = os.path.join(atlas_dir, file_name)
+
+        metadata = None
+        if self.metadata_cache is not None:
+            with profiling.span('metadata_cache_read'):
+                metadata = self.metadata_cache.get(full_path)
+
+            if metadata is None:
+                profiling.count('metadata_cache_misses')
+            else:
+                profiling.count('metadata_cache_hits')
+
+        if metadata is None:
+            metadata = self.read_xml_metadata(atlas_dir, file_name)
+            if self.metadata_cache is not None:
+                self.metadata_cache.put(full_path, metadata,
+                                        metadata['images'] +
+                                        metadata['summaries'])
+
+        return metadata
+
+
+    def load_image(self, img_file):
+        '''
+        Opens an atlas image, through the volume cache if it is in use.
+        With a memory budget the image file is kept open, so the chunks read
+        one after another continue decompressing where the previous one
+        stopped instead of from the start of the file.
+
+        Parameters
+        ----------
+        img_file: string
+
+        Returns
+        -------
+        nib.Nifti1Image
+        '''
+        profiling.count('images_opened')
+
+        with profiling.span('image_open'):
+            if self.volume_cache is not None:
+                return self.volume_cache.load(img_file)
 
+            if self.memory_budget is not None:
+                return nib.load(img_file, keep_file_open=True)
 
-        for node in root.childNodes:
-            node_name = node.nodeName
-            if node.nodeType == node.ELEMENT_NODE and node_name == 'data':
-                for curr_node in node.childNodes:
+            return nib.load(img_file)
 
-                    if curr_node.nodeType == node.ELEMENT_NODE:
-                        curr_node_name = curr_node.nodeName
-                        if curr_node_name == 'label':
-                            n = int(self._get_dom_attribute_value(curr_node, 
-                                                                  'index', '0'))
-                            l = str(curr_node.firstChild.data)
-                            atlas.add_label(n, l)
 
-                            x = int(self._get_dom_attribute_value(curr_node, 'x', '0'))
-                            y = int(self._get_dom_attribute_value(curr_node, 'y', '0'))
-                            z = int(self._get_dom_attribute_value(curr_node, 'z', '0'))
-                            v = int(self._get_dom_attribute_value(curr_node, 'v', '0'))
+    def create_atlas(self, metadata):
+        '''
+        Opens the atlas images listed in metadata and returns the
+        corresponding Atlas. Opening an image only reads its header, unless
+        the volume cache is in use, where it decompresses the images missing
+        from the cache; those are opened concurrently.
+
+        Parameters
+        ----------
+        metadata: dict, see read_xml_metadata
+
+        Returns
+        -------
+        Atlas
+        '''
+        n_threads = 1 if self.volume_cache is None else self.n_threads
 
-                            #ref = self._get_dom_attribute_value(curr_node, 'ref', '')
+        n_images = len(metadata['images'])
+        images = map_threads(self.load_image,
+                             metadata['images'] + metadata['summaries'],
+                             n_threads)
 
-                            atlas.add_centre(n, x, y, z, v)
-                            #atlas.add_reference(n, ref)
+        atlas_images = images[:n_images]
+        atlas_summaries = images[n_images:]
+        atlas_name = str(metadata['name'])
+
+        if metadata['type'] == 'probs':
+            atlas = StatsAtlas(atlas_images, atlas_summaries, atlas_name,
+                               metadata['lower'], metadata['upper'],
+                               metadata['precision'],
+                               str(metadata['stats_name']),
+                               str(metadata['units']))
+            atlas.set_compact(self.compact)
+
+        elif metadata['type'] == 'label':
+            atlas = LabelAtlas(atlas_images, atlas_summaries, atlas_name)
+
+        atlas.set_label_table(label_table_from_dict(metadata['labels']))
+        atlas.set_metadata_cache(self.metadata_cache, metadata['images'])
+        atlas.set_memory_budget(self.memory_budget)
 
         return atlas
 
 
+    def read_xml_atlas(self, atlas_dir, file_name):
+        '''
+        Process the data inside an Atlas definition XML file and returns the
+        corresponding Atlas.
+
+        Parameters
+        ----------
+        atlas_dir: string
+
+        file_name: string
+
+        Returns
+        -------
+        Atlas
+
+        '''
+        return self.create_atlas(self.get_xml_metadata(atlas_dir, file_name))
@@ -1,35 +1,91 @@
 
 import os
 from atlas import Atlas, LabelAtlas, StatsAtlas
-from atlas_files import AtlasFiles
+from atlas_files import AtlasFiles, map_threads
+from cohort import query_masks
 
 
 class AtlasGroup:
     '''
+    Registry of the atlases found in FSL atlas paths.
+    Only the atlases headers are read on creation, each atlas images and
+    labels are loaded the first time the atlas is requested, or all at
+    once with load_atlases. The headers, and the atlases and their data in
+    load_atlases, are read concurrently by a pool of threads.
     '''
 
-    def __init__(self):
+    def __init__(self, volume_cache=False, compact=False, memory_budget=None,
+                 n_threads=None):
+        '''
+        Parameters
+        ----------
+        volume_cache: boolean
+        True to load the atlas images through the on-disk cache of
+        decompressed volumes, see atlas_cache.VolumeCache.
+
+        compact: boolean
+        True to keep the probability volumes quantized in memory, see
+        StatsAtlas.set_compact.
+
+        memory_budget: int
+        Maximum number of bytes of atlas data read at once by the queries,
+        see Atlas.set_memory_budget.
+
+        n_threads: int
+        Number of threads that read the atlas files, the number of CPUs by
+        default, see atlas_files.map_threads.
+        '''
         self.atlases = {}
+        self.headers = {}
+        self.volume_cache = volume_cache
+        self.compact = compact
+        self.memory_budget = memory_budget
+        self.n_threads = n_threads
         self.create()
 
 
     def create(self):
         '''
-        atlases is a string->img dict
-        This function fills the atlases dict if empty with the data obtained
-        from each .xml file found in FSL atlas paths.
+        headers is a string->dict dict
+        This function fills the headers dict if empty with the header
+        obtained from each .xml file found in FSL atlas paths.
+        The files are read concurrently.
 
         '''
         atlas_files = AtlasFiles()
 
-        if (len(self.atlases) == 0):
+        if (len(self.headers) == 0):
             atlas_dirs = atlas_files.get_atlas_path_elements()
 
+            xml_files = []
             for d in atlas_dirs:
                 if os.path.exists(d):
                     files = atlas_files.find(os.listdir(d), '.xml$')
-                    for f in files:
-                        self.read_atlas(d, f)
+                    xml_files.extend((d, f) for f in files)
+
+            def read_header(xml_file):
+                return atlas_files.read_xml_header(*xml_file)
+
+            headers = map_threads(read_header, xml_files, self.n_threads)
+            for header in headers:
+                self.headers[header['name']] = header
+
+
+    def read_atlas_header(self, path, file_name):
+        '''
+        Adds to self.headers the header of the atlas in path/file_name
+
+        Parameters
+        ----------
+        path: string
+        Path where the atlas files are
+
+        file_name: string
+        Atlas file name
+        '''
+        atlas_files = AtlasFiles()
+        header = atlas_files.read_xml_header(path, file_name)
+        self.headers[header['name']] = header
 
 
     def read_atlas(self, path, file_name):
@@ -44,14 +100,75 @@ class AtlasGroup:
         file_name: string
         Atlas file name
         '''
-        atlas_files = AtlasFiles()
+        atlas_files = self._get_atlas_files(self.n_threads)
         atlas = atlas_files.read_xml_atlas(path, file_name)
         self.atlases[atlas.name] = atlas
 
 
+    def _get_atlas_files(self, n_threads):
+        '''
+        Returns the AtlasFiles that read the atlases with the options of
+        this group, opening the images of each atlas with n_threads threads.
+        '''
+        return AtlasFiles(volume_cache=self.volume_cache, compact=self.compact,
+                          memory_budget=self.memory_budget,
+                          n_threads=n_threads)
+
+
+    def load_atlases(self, names=None, load_data=True):
+        '''
+        Loads the atlases with the given names, and with load_data their
+        data, which is where the atlas files are decompressed, concurrently
+        in a pool of self.n_threads threads, so the total time approaches
+        that of the slowest atlas instead of the sum of all of them.
+
+        Parameters
+        ----------
+        names: list of strings
+        Atlas names, all the available atlases by default.
+
+        load_data: boolean
+        True to also load the data of each atlas, see Atlas.load_data.
+
+        Returns
+        -------
+        list with the Atlas of each name, None for invalid names
+        '''
+        if names is None:
+            names = self.get_atlas_names()
+
+        def load_atlas(name):
+            atlas = self.atlases.get(name)
+            if atlas is None and name in self.headers:
+                header = self.headers[name]
+                # the images of each atlas are opened in this thread
+                atlas_files = self._get_atlas_files(1)
+                atlas = atlas_files.read_xml_atlas(header['atlas_dir'],
+                                                   header['file_name'])
+            if atlas is not None and load_data:
+                atlas.load_data()
+            return atlas
+
+        atlases = map_threads(load_atlas, names, self.n_threads)
+
+        for atlas in atlases:
+            if atlas is not None:
+                self.atlases[atlas.name] = atlas
+
+        return atlases
+
+
+    def get_atlas_names(self):
+        '''
+        Returns the names of all the available atlases
+        '''
+        return self.headers.keys()
+
+
     def get_atlas_by_name(self, name):
         '''
-        Returns the atlas with the given name
+        Returns the atlas with the given name, loading it if this is the
+        first time it is requested.
 
         Parameters
         ----------
@@ -59,13 +176,50 @@ class AtlasGroup:
         Atlas name
 
         '''
-        return self.atlases[name] if self.atlases.has_key(name) else None
+        if name not in self.atlases and name in self.headers:
+            header = self.headers[name]
+            self.read_atlas(header['atlas_dir'], header['file_name'])
+
+        return self.atlases[name] if name in self.atlases else None
 
 
-    def get_compatible_atlases(ref_img):
+    def get_compatible_atlases(self, ref_img):
         '''
+        Selects in every atlas the images compatible with ref_img
         '''
-        for nom in atlases.keys():
-            atlases[nom].select_compatible_images(ref_img)
+        self.load_atlases(load_data=False)
+
+        for nom in self.get_atlas_names():
+            self.get_atlas_by_name(nom).select_compatible_images(ref_img)
+
+
+    def query_masks(self, atlas_name, mask_paths, measure='avgprob',
+                    n_jobs=None):
+        '''
+        Queries every mask in mask_paths against the atlas with the given
+        name, spreading the masks across a pool of worker processes that
+        share one copy of the atlas data.
+
+        Parameters
+        ----------
+        atlas_name: string
+        Atlas name
+
+        mask_paths: list of strings
+        Mask image files.
 
+        measure: string
+        'avgprob' or 'roiover', see Atlas.query_mask_all
+
+        n_jobs: int
+        Number of worker processes, the number of CPUs by default.
+
+        Returns
+        -------
+        list with the dict returned by Atlas.query_mask_all for each mask
+        '''
+        atlas = self.get_atlas_by_name(atlas_name)
+        if atlas is None:
+            raise ValueError('Invalid atlas name ' + str(atlas_name))
 
+        return query_masks(atlas, mask_paths, measure, n_jobs)
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+'''
+Checks that the atlasquerpy query engines give the same results as the code
+they replaced, over synthetic atlases, and prints one line per check. Exits
+with 1 if any of them differs:
+
+python benchmarks/check_equivalence.py -r 4 -s 8 -n 2000
+'''
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic_atlas import get_grid
+from synthetic_atlas import write_synthetic_atlases, write_synthetic_mask
+
+
+#-------------------------------------------------------------------------------
+def set_parser():
+    parser = argparse.ArgumentParser(description='Atlasquerpy equivalence '
+                                                 'checks')
+    parser.add_argument('-r', '--resolution', dest='resolution',
+                        required=False, default=4., type=float,
+                        help='voxel size of the synthetic atlases in mm')
+    parser.add_argument('-s', '--structures', dest='structures',
+                        required=False, default=8, type=int,
+                        help='number of structures of the synthetic atlases')
+    parser.add_argument('-n', '--mask-voxels', dest='mask_voxels',
+                        required=False, default=2000, type=int,
+                        help='approximate number of voxels of the masks')
+    parser.add_argument('-c', '--coords', dest='coords', required=False,
+                        default=500, type=int,
+                        help='number of coordinates of the coordinate checks')
+    parser.add_argument('--threads', dest='threads', required=False,
+                        default=4, type=int,
+                        help='number of threads of the concurrent loading')
+
+    return parser
+#-------------------------------------------------------------------------------
+
+
+def get_reference_sums(atlas, mask_img, struct_ids):
+    '''
+    Returns the sum of the probabilities of each structure of struct_ids
+    weighted by the mask values, mapping one mask voxel at a time through
+    the nipy CoordinateMaps, as _get_roi_mask_intersect did before the
+    vectorised engine of mask_intersect.
+
+    Parameters
+    ----------
+    atlas: StatsAtlas or LabelAtlas
+
+    mask_img: nib.Nifti1Image
+
+    struct_ids: list of ints
+
+    Returns
+    -------
+    dict with the sum of each structure index
+    '''
+    from coord_transform import get_3D_coordmap
+    from coord_transform import voxcoord_to_mm, mm_to_voxcoord
+
+    mask_vol = np.asarray(mask_img.get_data())
+    atlas_vol = np.asarray(atlas.image.dataobj)
+
+    mask_cm = get_3D_coordmap(mask_img)
+    atlas_cm = get_3D_coordmap(atlas.image)
+
+    sums = dict((struct_idx, 0.) for struct_idx in struct_ids)
+    for idx in np.argwhere(mask_vol):
+        mm = voxcoord_to_mm(mask_cm, *idx)
+        vox = np.round(mm_to_voxcoord(atlas_cm, *mm)).astype(int)
+        if np.any(vox < 0) or np.any(vox >= atlas_vol.shape[:3]):
+            continue
+
+        weight = float(mask_vol[tuple(idx)])
+        for struct_idx in struct_ids:
+            if atlas_vol.ndim == 4:
+                prob = atlas_vol[tuple(vox) + (struct_idx,)]
+            else:
+                prob = 100 if atlas_vol[tuple(vox)] == struct_idx else 0
+            sums[struct_idx] += prob * weight
+
+    return sums
+
+
+def check_mask_intersect(atlases, masks):
+    '''
+    Compares the average probabilities of every structure of the atlases
+    in the masks with the per voxel reference, see get_reference_sums.
+    Returns the list of the mismatches.
+    '''
+    mismatches = []
+    for atlas_type, atlas in sorted(atlases.items()):
+        struct_ids = [struct_idx for struct_idx in atlas.get_labels_ids()
+                      if struct_idx < len(atlas.get_structure_stats())]
+
+        for grid, mask_img in sorted(masks.items()):
+            ref_sums = get_reference_sums(atlas, mask_img, struct_ids)
+            mask_sum = float(np.sum(mask_img.get_data()))
+
+            for struct_idx in struct_ids:
+                ref = ref_sums[struct_idx] / mask_sum
+                value = atlas.get_avg_probability(mask_img, struct_idx)
+                if not np.allclose(ref, value):
+                    mismatches.append('%s %s structure %d: %g != %g' %
+                                      (atlas_type, grid, struct_idx, value,
+                                       ref))
+
+    return mismatches
+
+
+def check_compact(float_atlases, compact_atlases, masks, coords):
+    '''
+    Compares the results of the atlases loaded in compact mode with the
+    ones of the atlases loaded as floats: the tables of query_mask_all and
+    the descriptions of the coordinates, with and without a threshold.
+    Returns the list of the mismatches.
+    '''
+    mismatches = []
+    for atlas_type, atlas in sorted(float_atlases.items()):
+        compact_atlas = compact_atlases[atlas_type]
+
+        for grid, mask_img in sorted(masks.items()):
+            values = atlas.query_mask_all(mask_img)
+            compact_values = compact_atlas.query_mask_all(mask_img)
+
+            for struct_idx in sorted(values):
+                if not np.allclose(values[struct_idx],
+                                   compact_values.get(struct_idx)):
+                    mismatches.append('%s %s structure %d: %s != %s' %
+                                      (atlas_type, grid, struct_idx,
+                                       compact_values.get(struct_idx),
+                                       values[struct_idx]))
+
+        for threshold in (None, 50):
+            for x, y, z in coords:
+                text = atlas.get_description(x, y, z, threshold)
+                compact_text = compact_atlas.get_description(x, y, z,
+                                                             threshold)
+                if text != compact_text:
+                    mismatches.append('%s %g,%g,%g: %r != %r' %
+                                      (atlas_type, x, y, z, compact_text,
+                                       text))
+
+    return mismatches
+
+
+def check_threads(n_threads):
+    '''
+    Compares the atlases loaded by AtlasGroup.load_atlases with one thread
+    with the ones loaded with n_threads threads: their structures, images
+    and structure stats. Returns the list of the mismatches.
+    '''
+    from atlas_group import AtlasGroup
+
+    serial_group = AtlasGroup(n_threads=1)
+    threaded_group = AtlasGroup(n_threads=n_threads)
+
+    names = sorted(serial_group.get_atlas_names())
+    if names != sorted(threaded_group.get_atlas_names()):
+        return ['atlas names: %s != %s' %
+                (sorted(threaded_group.get_atlas_names()), names)]
+
+    mismatches = []
+    for atlas, threaded_atlas in zip(serial_group.load_atlases(names),
+                                     threaded_group.load_atlases(names)):
+        struct_ids = sorted(atlas.get_labels_ids())
+        if (struct_ids != sorted(threaded_atlas.get_labels_ids()) or
+            atlas.get_structure_names(struct_ids) !=
+            threaded_atlas.get_structure_names(struct_ids)):
+            mismatches.append(atlas.name + ': structures')
+
+        images = zip(atlas.images + atlas.summaries,
+                     threaded_atlas.images + threaded_atlas.summaries)
+        for img, threaded_img in images:
+            if not np.array_equal(np.asarray(img.dataobj),
+                                  np.asarray(threaded_img.dataobj)):
+                mismatches.append(atlas.name + ': image data')
+
+        if not np.allclose(atlas.get_structure_stats().mass,
+                           threaded_atlas.get_structure_stats().mass):
+            mismatches.append(atlas.name + ': structure stats')
+
+    return mismatches
+
+
+def run_checks(work_dir, args):
+    '''
+    Creates the synthetic atlases and masks in work_dir and runs all the
+    checks. Returns a list of (check name, mismatches) pairs.
+    '''
+    atlas_dir = os.path.join(work_dir, 'atlases')
+    os.environ['FSLATLASPATH'] = atlas_dir
+    os.environ['ATLASQUERPY_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+
+    synth = write_synthetic_atlases(atlas_dir, args.resolution,
+                                    args.structures)
+
+    grid_mask_file = os.path.join(work_dir, 'mask_atlas_grid.nii.gz')
+    write_synthetic_mask(grid_mask_file, synth['shape'], synth['affine'],
+                         args.mask_voxels)
+
+    other_shape, other_affine = get_grid(args.resolution * 1.5)
+    other_mask_file = os.path.join(work_dir, 'mask_other_grid.nii.gz')
+    write_synthetic_mask(other_mask_file, other_shape, other_affine,
+                         int(args.mask_voxels / 1.5**3))
+
+    from atlas_group import AtlasGroup
+
+    masks = {'atlas_grid': nib.load(grid_mask_file),
+             'other_grid': nib.load(other_mask_file)}
+
+    atlas_group = AtlasGroup()
+    atlases = {'prob': atlas_group.get_atlas_by_name(synth['prob']),
+               'label': atlas_group.get_atlas_by_name(synth['label'])}
+
+    compact_group = AtlasGroup(compact=True)
+    compact_atlases = dict((atlas_type, compact_group.get_atlas_by_name(
+                            atlas.name)) for atlas_type, atlas
+                           in atlases.items())
+
+    rng = np.random.RandomState(0)
+    vox = (rng.rand(args.coords, 3) * np.array(synth['shape'])).astype(int)
+    coords = np.dot(vox, synth['affine'][:3, :3].T) + synth['affine'][:3, 3]
+
+    checks = []
+    checks.append(('mask_intersect', check_mask_intersect(atlases, masks)))
+    checks.append(('compact', check_compact(atlases, compact_atlases, masks,
+                                            coords)))
+    checks.append(('threads', check_threads(args.threads)))
+
+    return checks
+
+
+def main(argv=None):
+
+    args = set_parser().parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='atlasquerpy_check_')
+    try:
+        checks = run_checks(work_dir, args)
+    finally:
+        shutil.rmtree(work_dir)
+
+    failed = False
+    for name, mismatches in checks:
+        if mismatches:
+            failed = True
+            print(name + ': ' + str(len(mismatches)) + ' mismatches')
+            for mismatch in mismatches:
+                print('    ' + mismatch)
+        else:
+            print(name + ': ok')
+
+    return 1 if failed else 0
+
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
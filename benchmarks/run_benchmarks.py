@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+'''
+Times the atlasquerpy load, coordinate and mask query paths over synthetic
+atlases and writes the results as JSON:
+
+python benchmarks/run_benchmarks.py -r 2 -s 48 -n 20000 -o bench.json
+'''
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from synthetic_atlas import get_grid
+from synthetic_atlas import write_synthetic_atlases, write_synthetic_mask
+
+
+#-------------------------------------------------------------------------------
+def set_parser():
+    parser = argparse.ArgumentParser(description='Atlasquerpy benchmarks')
+    parser.add_argument('-r', '--resolution', dest='resolution',
+                        required=False, default=2., type=float,
+                        help='voxel size of the synthetic atlases in mm')
+    parser.add_argument('-s', '--structures', dest='structures',
+                        required=False, default=48, type=int,
+                        help='number of structures of the synthetic atlases')
+    parser.add_argument('-n', '--mask-voxels', dest='mask_voxels',
+                        required=False, default=20000, type=int,
+                        help='approximate number of voxels of the masks')
+    parser.add_argument('-c', '--coords', dest='coords', required=False,
+                        default=1000, type=int,
+                        help='number of coordinates of the coordinate queries')
+    parser.add_argument('--repeat', dest='repeat', required=False,
+                        default=5, type=int,
+                        help='number of times each benchmark is run')
+    parser.add_argument('-o', '--output', dest='output', required=False,
+                        default='',
+                        help='JSON file for the results, stdout by default')
+    parser.add_argument('--keep', dest='keep', required=False,
+                        action='store_true', default=False,
+                        help='do not remove the synthetic atlas directory')
+
+    return parser
+#-------------------------------------------------------------------------------
+
+
+def time_it(func, repeat):
+    '''
+    Runs func repeat times and returns the timing statistics in seconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return {'min': min(times), 'median': float(np.median(times)),
+            'max': max(times), 'repeat': repeat}
+
+
+def run_cli(args):
+    '''
+    Runs the atlasquerpy command line with args.
+    '''
+    cmd = [sys.executable, os.path.join(REPO_DIR, 'atlasquerpy')] + args
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, stdout=devnull)
+
+
+def run_benchmarks(work_dir, args):
+    '''
+    Creates the synthetic atlases and masks in work_dir and runs all the
+    benchmarks. Returns a dict with the timing of each benchmark.
+    '''
+    atlas_dir = os.path.join(work_dir, 'atlases')
+    os.environ['FSLATLASPATH'] = atlas_dir
+    os.environ['ATLASQUERPY_CACHE_DIR'] = os.path.join(work_dir, 'cache')
+
+    synth = write_synthetic_atlases(atlas_dir, args.resolution,
+                                    args.structures)
+
+    grid_mask_file = os.path.join(work_dir, 'mask_atlas_grid.nii.gz')
+    write_synthetic_mask(grid_mask_file, synth['shape'], synth['affine'],
+                         args.mask_voxels)
+
+    other_shape, other_affine = get_grid(args.resolution * 1.5)
+    other_mask_file = os.path.join(work_dir, 'mask_other_grid.nii.gz')
+    write_synthetic_mask(other_mask_file, other_shape, other_affine,
+                         int(args.mask_voxels / 1.5**3))
+
+    from atlas_group import AtlasGroup
+
+    results = {}
+    repeat = args.repeat
+
+    results['atlas_group_create_cold'] = time_it(AtlasGroup, 1)
+    results['atlas_group_create'] = time_it(AtlasGroup, repeat)
+
+    def load_atlases():
+        atlas_group = AtlasGroup()
+        for name in (synth['prob'], synth['label']):
+            atlas_group.get_atlas_by_name(name).load_data()
+
+    results['atlas_load'] = time_it(load_atlases, repeat)
+
+    atlas_group = AtlasGroup()
+    atlases = {'prob': atlas_group.get_atlas_by_name(synth['prob']),
+               'label': atlas_group.get_atlas_by_name(synth['label'])}
+
+    rng = np.random.RandomState(0)
+    shape = np.array(synth['shape'])
+    vox = (rng.rand(args.coords, 3) * shape).astype(int)
+    coords = np.dot(vox, synth['affine'][:3, :3].T) + synth['affine'][:3, 3]
+
+    masks = {'atlas_grid': nib.load(grid_mask_file),
+             'other_grid': nib.load(other_mask_file)}
+
+    for atlas_type, atlas in atlases.items():
+        atlas.load_data()
+        struct_idx = sorted(atlas.get_labels_ids())[1]
+
+        def describe():
+            for x, y, z in coords:
+                atlas.get_description(x, y, z)
+
+        results[atlas_type + '_get_description'] = time_it(describe, repeat)
+        results[atlas_type + '_describe_coords'] = \
+            time_it(lambda: atlas.describe_coords(coords), repeat)
+
+        for grid, mask_img in masks.items():
+            prefix = atlas_type + '_' + grid + '_'
+
+            results[prefix + 'get_avg_probability'] = \
+                time_it(lambda: atlas.get_avg_probability(mask_img,
+                                                          struct_idx), repeat)
+            results[prefix + 'get_roi_overlap'] = \
+                time_it(lambda: atlas.get_roi_overlap(mask_img,
+                                                      struct_idx), repeat)
+            results[prefix + 'query_mask_all'] = \
+                time_it(lambda: atlas.query_mask_all(mask_img), repeat)
+
+    x, y, z = coords[0]
+    coord_arg = '%g,%g,%g' % (x, y, z)
+
+    results['cli_dumpatlases'] = \
+        time_it(lambda: run_cli(['-a', synth['prob'], '--dumpatlases']),
+                repeat)
+    results['cli_coords'] = \
+        time_it(lambda: run_cli(['-a', synth['prob'],
+                                 '--coords=' + coord_arg]), repeat)
+    results['cli_mask'] = \
+        time_it(lambda: run_cli(['-a', synth['prob'], '-m', grid_mask_file]),
+                repeat)
+
+    return results
+
+
+def main(argv=None):
+
+    args = set_parser().parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='atlasquerpy_bench_')
+    try:
+        results = run_benchmarks(work_dir, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    report = {'params': {'resolution': args.resolution,
+                         'structures': args.structures,
+                         'mask_voxels': args.mask_voxels,
+                         'coords': args.coords,
+                         'repeat': args.repeat},
+              'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'nibabel': nib.__version__,
+                              'platform': platform.platform()},
+              'results': results}
+
+    report_text = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report_text + '\n')
+    else:
+        print(report_text)
+
+    if args.keep:
+        sys.stderr.write('Synthetic atlases kept in ' + work_dir + '\n')
+
+    return 0
+
+#-------------------------------------------------------------------------------
+if __name__ == "__main__":
+    sys.exit(main())
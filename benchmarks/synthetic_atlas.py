@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+
+'''
+Synthetic FSL-style atlases for benchmarking atlasquerpy without an FSL
+install. write_synthetic_atlases creates an atlas directory, to be used as
+$FSLATLASPATH, with a probabilistic and a label atlas over an MNI-like grid.
+'''
+
+PROB_ATLAS_NAME = 'Synthetic Probabilistic Atlas'
+LABEL_ATLAS_NAME = 'Synthetic Label Atlas'
+
+MNI_SHAPE_2MM = (91, 109, 91)
+MNI_ORIGIN = (90., -126., -72.)
+
+
+def get_grid(resolution):
+    '''
+    Returns the shape and affine of an MNI-like grid with the given voxel
+    size in mm.
+    '''
+    shape = tuple(int(round(s * 2. / resolution)) for s in MNI_SHAPE_2MM)
+
+    affine = np.diag([-resolution, resolution, resolution, 1.])
+    affine[:3, 3] = MNI_ORIGIN
+
+    return shape, affine
+
+
+def make_prob_volume(shape, n_structs, rng):
+    '''
+    Returns a 4D uint8 volume with one probability map, in percentages, per
+    structure. Each structure is a blob whose probability decreases from its
+    centre.
+    '''
+    prob_vol = np.zeros(shape + (n_structs,), dtype=np.uint8)
+
+    shape = np.array(shape)
+    radius = max(2, int(shape.min() / 6))
+
+    for v in range(n_structs):
+        centre = np.array([rng.randint(radius, s - radius) for s in shape])
+        lo = np.maximum(centre - radius, 0)
+        hi = np.minimum(centre + radius + 1, shape)
+
+        i, j, k = np.ogrid[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        dist = np.sqrt((i - centre[0])**2 + (j - centre[1])**2 +
+                       (k - centre[2])**2) / radius
+
+        prob = np.clip(np.round(100 * (1 - dist)), 0, 100)
+        prob_vol[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2], v] = prob
+
+    return prob_vol
+
+
+def make_atlas_xml(name, atlas_type, image, summary, n_labels):
+    '''
+    Returns the content of an FSL atlas definition XML file.
+    '''
+    labels = ''.join('<label index="%d" x="0" y="0" z="0">Structure %d</label>\n'
+                     % (n, n) for n in range(n_labels))
+
+    return ('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+            '<atlas version="1.0">\n'
+            '<header>\n'
+            '<name>%s</name>\n'
+            '<type>%s</type>\n'
+            '<images>\n'
+            '<imagefile>%s</imagefile>\n'
+            '<summaryimagefile>%s</summaryimagefile>\n'
+            '</images>\n'
+            '</header>\n'
+            '<data>\n%s</data>\n'
+            '</atlas>\n') % (name, atlas_type, image, summary, labels)
+
+
+def write_synthetic_atlases(atlas_dir, resolution=2., n_structs=48, seed=0):
+    '''
+    Writes a probabilistic and a label synthetic atlas, with their XML
+    definitions and NIfTI images, into atlas_dir.
+
+    Parameters
+    ----------
+    atlas_dir: string
+    Directory to be used as $FSLATLASPATH
+
+    resolution: float
+    Voxel size in mm
+
+    n_structs: int
+    Number of structures of the atlases
+
+    seed: int
+    Random seed
+
+    Returns
+    -------
+    dict with the names of the 'prob' and 'label' atlases, and the 'shape'
+    and 'affine' of their grid.
+    '''
+    rng = np.random.RandomState(seed)
+    shape, affine = get_grid(resolution)
+
+    img_dir = os.path.join(atlas_dir, 'Synthetic')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+
+    prob_vol = make_prob_volume(shape, n_structs, rng)
+
+    max_prob = prob_vol.max(axis=3)
+    lab_vol = (np.argmax(prob_vol, axis=3) + 1).astype(np.int16)
+    lab_vol[max_prob == 0] = 0
+
+    res = '%gmm' % resolution
+    nib.save(nib.Nifti1Image(prob_vol, affine),
+             os.path.join(img_dir, 'synth-prob-' + res + '.nii.gz'))
+    nib.save(nib.Nifti1Image(lab_vol, affine),
+             os.path.join(img_dir, 'synth-maxprob-' + res + '.nii.gz'))
+
+    with open(os.path.join(atlas_dir, 'synthetic_prob.xml'), 'w') as f:
+        f.write(make_atlas_xml(PROB_ATLAS_NAME, 'Probabilistic',
+                               '/Synthetic/synth-prob-' + res,
+                               '/Synthetic/synth-maxprob-' + res,
+                               n_structs))
+
+    with open(os.path.join(atlas_dir, 'synthetic_label.xml'), 'w') as f:
+        f.write(make_atlas_xml(LABEL_ATLAS_NAME, 'Label',
+                               '/Synthetic/synth-maxprob-' + res,
+                               '/Synthetic/synth-maxprob-' + res,
+                               n_structs + 1))
+
+    return {'prob': PROB_ATLAS_NAME, 'label': LABEL_ATLAS_NAME,
+            'shape': shape, 'affine': affine}
+
+
+def write_synthetic_mask(mask_file, shape, affine, n_voxels, seed=0):
+    '''
+    Writes a binary mask with a cube of about n_voxels voxels in the middle
+    of the grid.
+
+    Parameters
+    ----------
+    mask_file: string
+
+    shape: tuple
+
+    affine: 4x4 numpy array
+
+    n_voxels: int
+
+    seed: int
+    Random seed
+    '''
+    rng = np.random.RandomState(seed)
+
+    side = int(round(n_voxels ** (1. / 3)))
+    side = max(1, min(side, min(shape)))
+
+    lo = np.array(shape) // 2 - side // 2
+    hi = lo + side
+
+    mask_vol = np.zeros(shape, dtype=np.uint8)
+    mask_vol[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]] = 1
+
+    # leave out some voxels so the mask is not a perfect cube
+    holes = rng.rand(*shape) < 0.1
+    mask_vol[holes] = 0
+
+    nib.save(nib.Nifti1Image(mask_vol, affine), mask_file)
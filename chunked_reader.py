@@ -0,0 +1,272 @@
+#!/usr/bin/python
+
+import numpy as np
+
+import profiling
+
+
+'''
+Memory-bounded reads of atlas images. The atlas data is read through the
+nibabel array proxy of the image, img.dataobj, in chunks of structure
+volumes and z-slabs of the bounding box of the voxels of interest, with at
+most memory_budget bytes of atlas data read at once, so queries do not need
+the whole atlas volume in memory.
+'''
+
+
+def get_read_itemsize(dataobj):
+    '''
+    Returns the size in bytes of the values read from dataobj, after the
+    scaling applied by nibabel.
+    '''
+    return np.asarray(dataobj[(slice(0, 1),) * len(dataobj.shape)]).itemsize
+
+
+def get_chunk_shape(box_shape, n_volumes, itemsize, memory_budget):
+    '''
+    Returns the number of volumes and the depth of the z-slabs of the chunks
+    of a box of voxels read within memory_budget. Whole volumes of the box
+    are read together while they fit, otherwise one volume is read in
+    slabs of several z planes. A chunk has at least one z plane.
+
+    Parameters
+    ----------
+    box_shape: 3 ints
+    Shape of the box of voxels that is read.
+
+    n_volumes: int
+    Number of volumes that are read.
+
+    itemsize: int
+    Bytes per value.
+
+    memory_budget: int
+    Bytes.
+
+    Returns
+    -------
+    n_chunk_volumes, slab_depth: int
+    '''
+    plane_bytes = int(box_shape[0]) * int(box_shape[1]) * itemsize
+    volume_bytes = plane_bytes * int(box_shape[2])
+
+    n_chunk_volumes = int(max(1, min(n_volumes,
+                                     memory_budget // max(volume_bytes, 1))))
+    if n_chunk_volumes > 1 or volume_bytes <= memory_budget:
+        return n_chunk_volumes, int(box_shape[2])
+
+    slab_depth = int(max(1, memory_budget // max(plane_bytes, 1)))
+
+    return 1, slab_depth
+
+
+def _get_volume_runs(volumes, n_chunk_volumes):
+    '''
+    Splits the sorted volume indices into runs whose volumes lie within
+    n_chunk_volumes consecutive volumes, and returns the positions in
+    volumes where each run starts and ends.
+    '''
+    runs = []
+    start = 0
+    for pos in range(1, len(volumes) + 1):
+        if (pos == len(volumes) or
+            volumes[pos] - volumes[start] >= n_chunk_volumes):
+            runs.append((start, pos))
+            start = pos
+
+    return runs
+
+
+def iter_chunks(dataobj, bbox_min, bbox_max, memory_budget, volumes=None):
+    '''
+    Reads the box from bbox_min to bbox_max of a 3D or 4D image in chunks.
+
+    Parameters
+    ----------
+    dataobj: nibabel array proxy or numpy array
+    Image data, as in img.dataobj.
+
+    bbox_min, bbox_max: 3 ints
+    Lowest and highest voxel indices of the box, both included.
+
+    memory_budget: int
+    Maximum number of bytes of the chunks.
+
+    volumes: sorted int array-like
+    Indices of the volumes of a 4D image to read, all of them by default.
+    Ignored for 3D images.
+
+    Returns
+    -------
+    Iterator of (offset, vol_pos, chunk) tuples. offset is the voxel index
+    of chunk[0, 0, 0]. For 4D images, chunk[..., n] is the volume
+    volumes[vol_pos[n]], while for 3D images chunk is 3D and vol_pos is
+    None.
+    '''
+    bbox_min = np.asarray(bbox_min, dtype=int)
+    bbox_max = np.asarray(bbox_max, dtype=int)
+    box_shape = bbox_max - bbox_min + 1
+
+    is_4d = len(dataobj.shape) > 3
+    if is_4d:
+        if volumes is None:
+            volumes = np.arange(dataobj.shape[3])
+        volumes = np.asarray(volumes, dtype=int)
+        n_volumes = len(volumes)
+    else:
+        n_volumes = 1
+
+    if not n_volumes or np.any(box_shape <= 0):
+        return
+
+    n_chunk_volumes, slab_depth = get_chunk_shape(box_shape, n_volumes,
+                                                  get_read_itemsize(dataobj),
+                                                  memory_budget)
+
+    box = (slice(bbox_min[0], bbox_max[0] + 1),
+           slice(bbox_min[1], bbox_max[1] + 1))
+    slabs = [(z, slice(z, min(z + slab_depth, bbox_max[2] + 1)))
+             for z in range(bbox_min[2], bbox_max[2] + 1, slab_depth)]
+
+    if not is_4d:
+        for z, z_slice in slabs:
+            with profiling.span('chunk_read'):
+                chunk = np.asarray(dataobj[box + (z_slice,)])
+            profiling.count('chunk_bytes_read', chunk.nbytes)
+            yield np.array([bbox_min[0], bbox_min[1], z]), None, chunk
+        return
+
+    # volumes outer and slabs inner, so the chunks are read in file order
+    # and an open compressed image is decompressed once, not once per slab
+    for start, end in _get_volume_runs(volumes, n_chunk_volumes):
+        first = volumes[start]
+        vol_slice = slice(first, volumes[end - 1] + 1)
+
+        for z, z_slice in slabs:
+            with profiling.span('chunk_read'):
+                chunk = np.asarray(dataobj[box + (z_slice, vol_slice)])
+                chunk = chunk[..., volumes[start:end] - first]
+            profiling.count('chunk_bytes_read', chunk.nbytes)
+            yield (np.array([bbox_min[0], bbox_min[1], z]),
+                   np.arange(start, end), chunk)
+
+
+def iter_volume_chunks(dataobj, memory_budget=None, volumes=None):
+    '''
+    Reads whole volumes of a 4D image, or a whole 3D image, in chunks
+    within memory_budget, see iter_chunks, or one volume at a time if there
+    is no budget.
+
+    Parameters
+    ----------
+    dataobj: nibabel array proxy or numpy array
+
+    memory_budget: int
+    Bytes, None to read one whole volume at a time.
+
+    volumes: sorted int array-like
+    Indices of the volumes of a 4D image to read, all of them by default.
+
+    Returns
+    -------
+    Iterator of (offset, vol_pos, chunk) tuples, as in iter_chunks.
+    '''
+    shape = dataobj.shape
+    if memory_budget is not None:
+        for chunk_info in iter_chunks(dataobj, [0, 0, 0],
+                                      np.array(shape[:3]) - 1,
+                                      memory_budget, volumes):
+            yield chunk_info
+        return
+
+    offset = np.zeros(3, dtype=int)
+    if len(shape) == 3:
+        yield offset, None, np.asarray(dataobj[:, :, :])
+        return
+
+    if volumes is None:
+        volumes = range(shape[3])
+
+    for pos, v in enumerate(volumes):
+        chunk = np.asarray(dataobj[:, :, :, v])[..., np.newaxis]
+        yield offset, np.array([pos]), chunk
+
+
+def get_chunk_voxels(vox_idx, offset, chunk_shape):
+    '''
+    Returns the voxels of vox_idx that fall in a chunk read by iter_chunks.
+
+    Parameters
+    ----------
+    vox_idx: tuple of three int arrays
+    Voxel indices, inside the box of the chunks.
+
+    offset: 3 ints
+    Voxel index of the first voxel of the chunk.
+
+    chunk_shape: tuple of ints
+
+    Returns
+    -------
+    sel: int array
+    Positions in vox_idx of the voxels in the chunk.
+
+    chunk_idx: tuple of three int arrays
+    Indices of those voxels in the chunk.
+    '''
+    k = vox_idx[2]
+    sel = np.flatnonzero((k >= offset[2]) & (k < offset[2] + chunk_shape[2]))
+
+    return sel, tuple(idx[sel] - o for idx, o in zip(vox_idx, offset))
+
+
+def read_voxel_values(dataobj, vox_idx, memory_budget, volumes=None):
+    '''
+    Returns the values of a 3D or 4D image at the voxels vox_idx, reading
+    them in chunks, see iter_chunks.
+
+    Parameters
+    ----------
+    dataobj: nibabel array proxy or numpy array
+
+    vox_idx: tuple of three int arrays
+    Voxel indices.
+
+    memory_budget: int
+
+    volumes: sorted int array-like
+    Indices of the volumes of a 4D image to read, all of them by default.
+
+    Returns
+    -------
+    (N, ) array for 3D images, (N, n_volumes) array for 4D images
+    '''
+    vox_idx = tuple(np.asarray(idx, dtype=int) for idx in vox_idx)
+    n_vox = len(vox_idx[0])
+
+    shape = (n_vox,)
+    if len(dataobj.shape) > 3:
+        n_volumes = dataobj.shape[3] if volumes is None else len(volumes)
+        shape = (n_vox, n_volumes)
+
+    if not n_vox:
+        return np.zeros(shape)
+
+    values = None
+    bbox_min = [idx.min() for idx in vox_idx]
+    bbox_max = [idx.max() for idx in vox_idx]
+    for offset, vol_pos, chunk in iter_chunks(dataobj, bbox_min, bbox_max,
+                                              memory_budget, volumes):
+        if values is None:
+            values = np.zeros(shape, dtype=chunk.dtype)
+
+        sel, chunk_idx = get_chunk_voxels(vox_idx, offset, chunk.shape)
+        if vol_pos is None:
+            values[sel] = chunk[chunk_idx]
+        else:
+            values[sel[:, np.newaxis], vol_pos] = chunk[chunk_idx]
+
+    if values is None:
+        return np.zeros(shape)
+
+    return values
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+import numpy as np
+import nibabel as nib
+
+import profiling
+from coord_transform import get_affine, apply_affine
+
+
+'''
+Cluster report of a statistical map, like FSL autoaq: the map is
+thresholded, its connected clusters are found and every cluster is
+described by its size, its peak and its overlap with the atlas structures.
+'''
+
+
+def get_connectivity_structure(connectivity):
+    '''
+    Returns the scipy.ndimage.label structuring element of the given voxel
+    connectivity: 6 (faces), 18 (faces and edges) or 26 (faces, edges and
+    corners).
+    '''
+    from scipy import ndimage
+
+    if connectivity not in (6, 18, 26):
+        raise ValueError('Invalid connectivity ' + str(connectivity))
+
+    rank = {6: 1, 18: 2, 26: 3}[connectivity]
+
+    return ndimage.generate_binary_structure(3, rank)
+
+
+def label_clusters(stat_vol, threshold, min_size=1, connectivity=26):
+    '''
+    Finds the connected clusters of the voxels of stat_vol above threshold.
+
+    Parameters
+    ----------
+    stat_vol: 3D numpy array
+
+    threshold: float
+
+    min_size: int
+    Clusters with less voxels are discarded.
+
+    connectivity: int
+    6, 18 or 26, see get_connectivity_structure.
+
+    Returns
+    -------
+    cluster_vol: 3D int32 array
+    Cluster number of every voxel, 0 outside of the clusters. Clusters are
+    numbered from 1 by decreasing size.
+
+    sizes: (n_clusters, ) int array
+    Number of voxels of each cluster.
+    '''
+    from scipy import ndimage
+
+    with profiling.span('cluster_labelling'):
+        labs, n_labs = ndimage.label(stat_vol > threshold,
+                                     get_connectivity_structure(connectivity))
+
+        sizes = np.bincount(labs.ravel(), minlength=n_labs + 1)
+        sizes[0] = 0
+
+        # renumber the clusters by decreasing size, dropping the small ones
+        order = np.argsort(-sizes[1:], kind='mergesort') + 1
+        order = order[sizes[order] >= max(min_size, 1)]
+
+        renumber = np.zeros(n_labs + 1, dtype=np.int32)
+        renumber[order] = np.arange(1, len(order) + 1)
+
+        cluster_vol = renumber[labs]
+
+    return cluster_vol, sizes[order]
+
+
+def get_cluster_peaks(stat_vol, cluster_vol, n_clusters):
+    '''
+    Returns the peak value, the voxel of the peak and the stat weighted
+    centre of gravity of every cluster.
+
+    Parameters
+    ----------
+    stat_vol: 3D numpy array
+
+    cluster_vol: 3D int array, see label_clusters
+
+    n_clusters: int
+
+    Returns
+    -------
+    peaks: (n_clusters, ) float array
+
+    peak_vox: (n_clusters, 3) int array
+
+    cogs: (n_clusters, 3) float array, in voxels
+    '''
+    from scipy import ndimage
+
+    if not n_clusters:
+        return np.zeros(0), np.zeros((0, 3), dtype=int), np.zeros((0, 3))
+
+    index = np.arange(1, n_clusters + 1)
+
+    peaks = np.array(ndimage.maximum(stat_vol, cluster_vol, index), ndmin=1)
+    peak_vox = np.array(ndimage.maximum_position(stat_vol, cluster_vol,
+                                                 index), ndmin=2)
+    cogs = np.array(ndimage.center_of_mass(stat_vol, cluster_vol, index),
+                    ndmin=2)
+
+    return peaks, peak_vox.astype(int), cogs
+
+
+def get_cluster_report(atlas, stat_img, threshold, measure='avgprob',
+                       min_size=1, connectivity=26):
+    '''
+    Thresholds stat_img, finds its clusters and measures the overlap of
+    every cluster with every structure of atlas.
+    The clusters are labelled once and all the cluster by structure
+    overlaps come from one pass over the cluster voxels, see
+    Atlas.query_cluster_table.
+
+    Parameters
+    ----------
+    atlas: Atlas
+
+    stat_img: nib.Nifti1Image
+    3D statistical map.
+
+    threshold: float
+    Voxels with a value above threshold belong to the clusters.
+
+    measure: string
+    'avgprob' for the average probability of each structure in the
+    cluster or 'roiover' for the percentage of each structure covered by
+    the cluster.
+
+    min_size: int
+    Clusters with less voxels are discarded.
+
+    connectivity: int
+    6, 18 or 26, see get_connectivity_structure.
+
+    Returns
+    -------
+    list with a dict per cluster, sorted by decreasing size, with the
+    cluster 'index', its 'size' in voxels, its 'peak' value, the 'peak_mm'
+    and centre of gravity 'cog_mm' coordinates and the 'values' of measure
+    for each structure index, as in Atlas.query_mask_all.
+    '''
+    if measure not in ('avgprob', 'roiover'):
+        raise ValueError('Unknown measure ' + str(measure))
+
+    stat_vol = np.asarray(stat_img.get_data())
+    if stat_vol.ndim > 3:
+        if int(np.prod(stat_vol.shape[3:])) > 1:
+            raise ValueError('The statistical map must be a 3D image')
+        stat_vol = stat_vol.reshape(stat_vol.shape[:3])
+
+    cluster_vol, sizes = label_clusters(stat_vol, threshold, min_size,
+                                        connectivity)
+    n_clusters = len(sizes)
+
+    affine = get_affine(stat_img)
+    cluster_img = nib.Nifti1Image(cluster_vol, affine)
+
+    peaks, peak_vox, cogs = get_cluster_peaks(stat_vol, cluster_vol,
+                                              n_clusters)
+
+    table = atlas.query_cluster_table(cluster_img, n_clusters, measure)
+    columns = atlas.get_table_columns(table)
+
+    peaks_mm = apply_affine(affine, peak_vox)
+    cogs_mm = apply_affine(affine, cogs)
+
+    clusters = []
+    for c in range(n_clusters):
+        values = dict((struct_idx, column[c])
+                      for struct_idx, column in columns.items())
+
+        clusters.append({'index': c + 1, 'size': int(sizes[c]),
+                         'peak': float(peaks[c]),
+                         'peak_mm': peaks_mm[c].tolist(),
+                         'cog_mm': cogs_mm[c].tolist(),
+                         'values': values})
+
+    return clusters
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+import multiprocessing
+
+import nibabel as nib
+
+
+_cohort_atlas = None
+
+
+def _query_mask(args):
+    '''
+    Worker function: returns the (mask_path, values, error) triple of one
+    mask, see iter_query_masks.
+    '''
+    mask_path, measure = args
+
+    try:
+        values = _cohort_atlas.query_mask_all(nib.load(mask_path), measure)
+    except Exception as exc:
+        return mask_path, None, str(exc)
+
+    return mask_path, values, None
+
+
+def iter_query_masks(atlas, mask_paths, measure='avgprob', n_jobs=None):
+    '''
+    Queries every mask in mask_paths against atlas with a pool of worker
+    processes, yielding the results in the order of mask_paths as they are
+    ready.
+    The atlas data is loaded once before the workers are forked, so they
+    all share the same copy of it instead of loading their own.
+
+    Parameters
+    ----------
+    atlas: Atlas
+
+    mask_paths: list of strings
+    Mask image files.
+
+    measure: string
+    'avgprob' or 'roiover', see Atlas.query_mask_all
+
+    n_jobs: int
+    Number of worker processes, the number of CPUs by default.
+
+    Returns
+    -------
+    Generator of (mask_path, values, error) triples, where values is the
+    dict returned by Atlas.query_mask_all, or None and error the error
+    message if the mask could not be queried.
+    '''
+    global _cohort_atlas
+
+    atlas.load_data()
+    _cohort_atlas = atlas
+
+    tasks = [(mask_path, measure) for mask_path in mask_paths]
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _query_mask(task)
+        return
+
+    chunk_size = max(1, len(tasks) // (4 * n_jobs))
+
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for result in pool.imap(_query_mask, tasks, chunk_size):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def query_masks(atlas, mask_paths, measure='avgprob', n_jobs=None):
+    '''
+    Queries every mask in mask_paths against atlas with a pool of worker
+    processes, see iter_query_masks.
+    Raises RuntimeError if any of the masks could not be queried.
+
+    Returns
+    -------
+    list with the dict returned by Atlas.query_mask_all for each mask
+    '''
+    all_values = []
+    for mask_path, values, error in iter_query_masks(atlas, mask_paths,
+                                                     measure, n_jobs):
+        if error is not None:
+            raise RuntimeError('Problem querying mask ' + mask_path + ': ' +
+                               error)
+        all_values.append(values)
+
+    return all_values
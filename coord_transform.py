@@ -1,4 +1,6 @@
 
+import numpy as np
+import numpy.linalg as npl
 import nibabel as nib
 from nipy.io.nifti_ref import nifti2nipy
 from nipy.core.reference.array_coords import ArrayCoordMap
@@ -7,7 +9,8 @@ def voxcoord_to_mm(cm, i, j, k):
     '''
     Parameters
     ----------
-    cm: nipy.core.reference.coordinate_map.CoordinateMap
+    cm: nipy.core.reference.coordinate_map.CoordinateMap or ImageGeometry
+    With an ImageGeometry its precomputed affine is used.
 
     x, y, z: floats
 
@@ -16,6 +19,9 @@ def voxcoord_to_mm(cm, i, j, k):
     Triplet with real 3D world coordinates
 
     '''
+    if isinstance(cm, ImageGeometry):
+        return cm.voxcoord_to_mm(i, j, k)
+
     try:
         mm = cm([i, j, k])
     except:
@@ -29,7 +35,9 @@ def mm_to_voxcoord(cm, x, y, z):
     '''
     Parameters
     ----------
-    cm: nipy.core.reference.coordinate_map.CoordinateMap
+    cm: nipy.core.reference.coordinate_map.CoordinateMap or ImageGeometry
+    With an ImageGeometry its precomputed inverse affine is used, instead
+    of inverting the CoordinateMap on every call.
 
     x, y, z: floats
 
@@ -37,6 +45,9 @@ def mm_to_voxcoord(cm, x, y, z):
     -------
     Triplet with 3D voxel coordinates
     '''
+    if isinstance(cm, ImageGeometry):
+        return cm.mm_to_voxcoord(x, y, z)
+
     try:
         vox = cm.inverse()([x, y, z])
     except:
@@ -77,5 +88,91 @@ def get_coordmap_array(coordmap, shape):
     return ArrayCoordMap(coordmap, shape)
 
 
+def get_affine(img):
+    '''
+    Returns the 4x4 voxel to mm affine of the spatial part of img.
+
+    Parameters
+    ----------
+    img: nib.Nifti1Image or nipy Image
+
+    Returns
+    -------
+    4x4 numpy array
+    '''
+    if isinstance(img, nib.Nifti1Image):
+        return img.get_affine()
+
+    return get_3D_coordmap(img).affine
+
 
+def apply_affine(aff, pts):
+    '''
+    Applies the 4x4 affine aff to every row of pts.
+
+    Parameters
+    ----------
+    aff: 4x4 numpy array
+
+    pts: (N, 3) array of coordinates
+
+    Returns
+    -------
+    (N, 3) float array with the transformed coordinates
+    '''
+    pts = np.asarray(pts, dtype=float)
+
+    return np.dot(pts, aff[:3, :3].T) + aff[:3, 3]
+
+
+class ImageGeometry:
+    '''
+    Precomputed spatial transforms of an image: its voxel to mm affine and
+    the inverse mm to voxel affine.
+    They are computed once, so coordinate conversions do not need to
+    rebuild them on every call.
+    '''
+
+    def __init__(self, img):
+        '''
+        Parameters
+        ----------
+        img: nib.Nifti1Image or nipy Image
+        '''
+        self.img = img
+        self.shape = img.shape[:3]
+        self.affine = get_affine(img)
+        self.inv_affine = npl.inv(self.affine)
+
+
+    def voxcoord_to_mm(self, i, j, k):
+        '''
+        Returns a triplet with real 3D world coordinates of voxel i, j, k
+        '''
+        return apply_affine(self.affine, [[i, j, k]])[0]
+
+
+    def mm_to_voxcoord(self, x, y, z):
+        '''
+        Returns a triplet with the 3D voxel coordinates of x, y, z in mm
+        '''
+        return apply_affine(self.inv_affine, [[x, y, z]])[0]
+
+
+def get_geometry(img):
+    '''
+    Returns img if it is already an ImageGeometry, the ImageGeometry of img
+    otherwise.
+
+    Parameters
+    ----------
+    img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    Returns
+    -------
+    ImageGeometry
+    '''
+    if isinstance(img, ImageGeometry):
+        return img
 
+    return ImageGeometry(img)
@@ -1,8 +1,13 @@
 
+import numpy as np
+
+from coord_transform import get_geometry
+
+
 def is_valid_coordinate(img, i, j, k):
     '''
     '''
-    imgX, imgY, imgZ = img.shape
+    imgX, imgY, imgZ = img.shape[:3]
     return ((i >= 0 and i < imgX) and
             (j >= 0 and j < imgY) and
             (k >= 0 and k < imgZ))
@@ -15,3 +20,29 @@ def are_compatible_imgs(one_img, another_img):
     '''
     return (one_img.shape == another_img.shape)
 
+
+def get_grid_signature(img, decimals=5):
+    '''
+    Returns a hashable signature of the voxel grid of img: its 3D shape and
+    its affine rounded to decimals.
+
+    Parameters
+    ----------
+    img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    Returns
+    -------
+    tuple
+    '''
+    geom = get_geometry(img)
+    affine = np.round(geom.affine, decimals) + 0.
+
+    return (tuple(geom.shape), tuple(affine.ravel()))
+
+
+def are_same_grid(one_img, another_img):
+    '''
+    Returns true if one_img and another_img have the same 3D shape and
+    affine, so their voxels correspond one to one, false otherwise.
+    '''
+    return get_grid_signature(one_img) == get_grid_signature(another_img)
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+
+import numpy as np
+
+
+def create_label_table(indices, names, centres=None):
+    '''
+    Returns the LabelTable of the given labels.
+
+    Parameters
+    ----------
+    indices: sequence of int
+    Label indices, in any order. For repeated indices the last label is
+    kept.
+
+    names: sequence of strings
+    Name of each label.
+
+    centres: (n_labels, 4) array-like of x, y, z, v values, optional
+    Centre of each label, zeros by default.
+
+    Returns
+    -------
+    LabelTable
+    '''
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+
+    if centres is None:
+        centres = np.zeros((len(indices), 4), dtype=np.int32)
+    centres = np.asarray(centres, dtype=np.int32).reshape(-1, 4)
+
+    if len(names) != len(indices) or len(centres) != len(indices):
+        raise ValueError('Labels indices, names and centres must have the '
+                         'same length')
+
+    # position of the last label with each index, in index order
+    sorted_idx, last_pos = np.unique(indices[::-1], return_index=True)
+    order = len(indices) - 1 - last_pos
+
+    names = [names[pos] for pos in order]
+    name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in names], out=name_offsets[1:])
+
+    return LabelTable(sorted_idx, ''.join(names), name_offsets,
+                      centres[order])
+
+
+def label_table_from_dict(table):
+    '''
+    Returns the LabelTable stored in table, see LabelTable.to_dict.
+    '''
+    return LabelTable(table['indices'], str(table['names_data']),
+                      table['name_offsets'], table['centres'])
+
+
+class LabelTable:
+    '''
+    Compact table of the labels of an atlas.
+    The label indices are kept sorted in one int array, the names
+    concatenated in one string with an array of offsets, and the centres in
+    a (n_labels, 4) int array of x, y, z, v values, so atlases with
+    thousands of labels are loaded without building one Python object per
+    label.
+    It can be read like the dict from label index to label name that it
+    replaces.
+    '''
+
+    def __init__(self, indices=(), names_data='', name_offsets=None,
+                 centres=None):
+        '''
+        Parameters
+        ----------
+        indices: sequence of int
+        Label indices, sorted in ascending order and without repetitions,
+        see create_label_table.
+
+        names_data: string
+        Concatenated names of the labels.
+
+        name_offsets: sequence of int
+        Start offset of each name in names_data, plus the length of
+        names_data.
+
+        centres: (n_labels, 4) array-like of x, y, z, v values, optional
+        Centre of each label, zeros by default.
+        '''
+        self.indices = np.asarray(indices, dtype=np.int64).ravel()
+        self.names_data = names_data
+
+        if name_offsets is None:
+            name_offsets = np.zeros(len(self.indices) + 1)
+        self.name_offsets = np.asarray(name_offsets, dtype=np.int64)
+
+        if centres is None:
+            centres = np.zeros((len(self.indices), 4))
+        self.centres = np.asarray(centres, dtype=np.int32).reshape(-1, 4)
+
+        self._names = None
+
+
+    def to_dict(self):
+        '''
+        Returns a JSON serializable dict of the table arrays
+        '''
+        return {'indices': self.indices.tolist(),
+                'names_data': self.names_data,
+                'name_offsets': self.name_offsets.tolist(),
+                'centres': self.centres.tolist()}
+
+
+    def __len__(self):
+        return len(self.indices)
+
+
+    def __contains__(self, index):
+        return self.find(index) >= 0
+
+
+    def __getitem__(self, index):
+        pos = self.find(index)
+        if pos < 0:
+            raise KeyError(index)
+
+        return self._get_name(pos)
+
+
+    def has_key(self, index):
+        '''
+        '''
+        return index in self
+
+
+    def keys(self):
+        '''
+        Returns the list of label indices, in ascending order
+        '''
+        return self.indices.tolist()
+
+
+    def get(self, index, default=None):
+        '''
+        Returns the name of the label index, default if there is none
+        '''
+        pos = self.find(index)
+        if pos < 0:
+            return default
+
+        return self._get_name(pos)
+
+
+    def get_max_index(self):
+        '''
+        Returns the highest label index, -1 if the table is empty
+        '''
+        return int(self.indices[-1]) if len(self.indices) else -1
+
+
+    def find(self, index):
+        '''
+        Returns the position of the label index in the table arrays, -1 if
+        there is no such label.
+        '''
+        pos = np.searchsorted(self.indices, index)
+        if pos < len(self.indices) and self.indices[pos] == index:
+            return int(pos)
+
+        return -1
+
+
+    def find_all(self, indices):
+        '''
+        Returns the position of each of the label indices in the table
+        arrays, -1 for the ones that are not in the table.
+
+        Parameters
+        ----------
+        indices: int array-like
+
+        Returns
+        -------
+        int numpy array with the same shape as indices
+        '''
+        indices = np.asarray(indices)
+
+        pos = np.searchsorted(self.indices, indices)
+        pos = np.minimum(pos, max(len(self.indices) - 1, 0))
+
+        found = np.zeros(indices.shape, dtype=bool)
+        if len(self.indices):
+            found = self.indices[pos] == indices
+
+        return np.where(found, pos, -1)
+
+
+    def _get_name(self, pos):
+        '''
+        '''
+        return self.names_data[self.name_offsets[pos]:
+                               self.name_offsets[pos + 1]]
+
+
+    def get_names(self, indices, default='Unknown'):
+        '''
+        Returns the names of all the label indices at once.
+
+        Parameters
+        ----------
+        indices: int array-like
+
+        default: string
+        Name given to the indices that are not in the table.
+
+        Returns
+        -------
+        list of strings
+        '''
+        if self._names is None:
+            self._names = np.array([self._get_name(pos)
+                                    for pos in range(len(self.indices))] +
+                                   [default], dtype=object)
+
+        pos = self.find_all(np.ravel(indices))
+        names = self._names[pos]
+        names[pos < 0] = default
+
+        return names.tolist()
+
+
+    def get_centre(self, index):
+        '''
+        Returns the (x, y, z, v) centre of the label index, None if there is
+        no such label.
+        '''
+        pos = self.find(index)
+        if pos < 0:
+            return None
+
+        return tuple(self.centres[pos].tolist())
+
+
+    def add(self, index, name, centre=(0, 0, 0, 0)):
+        '''
+        Adds a label to the table, replacing the one with the same index.
+        '''
+        pos = self.find(index)
+        if pos >= 0:
+            self.names_data = (self.names_data[:self.name_offsets[pos]] +
+                               name +
+                               self.names_data[self.name_offsets[pos + 1]:])
+            self.name_offsets[pos + 1:] += (len(name) -
+                                            (self.name_offsets[pos + 1] -
+                                             self.name_offsets[pos]))
+            self.centres[pos] = centre
+            self._names = None
+            return
+
+        pos = int(np.searchsorted(self.indices, index))
+        offset = self.name_offsets[pos]
+
+        self.indices = np.insert(self.indices, pos, index)
+        self.centres = np.insert(self.centres, pos, centre, axis=0)
+        self.names_data = (self.names_data[:offset] + name +
+                           self.names_data[offset:])
+        self.name_offsets = np.insert(self.name_offsets, pos + 1,
+                                      offset + len(name))
+        self.name_offsets[pos + 2:] += len(name)
+
+        self._names = None
+
+
+    def set_centre(self, index, centre):
+        '''
+        Sets the (x, y, z, v) centre of the label index.
+        Raises KeyError if there is no such label.
+        '''
+        pos = self.find(index)
+        if pos < 0:
+            raise KeyError(index)
+
+        self.centres[pos] = centre
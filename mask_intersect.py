@@ -0,0 +1,419 @@
+#!/usr/bin/python
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import profiling
+from chunked_reader import get_read_itemsize
+from coord_transform import apply_affine, get_geometry
+from image_info import are_same_grid
+
+
+def get_vox2vox_affine(src_img, dst_img):
+    '''
+    Returns the affine that takes voxel indices of src_img to voxel indices
+    of dst_img going through their common mm space.
+
+    Parameters
+    ----------
+    src_img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    dst_img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    Returns
+    -------
+    4x4 numpy array
+    '''
+    return np.dot(get_geometry(dst_img).inv_affine,
+                  get_geometry(src_img).affine)
+
+
+def get_inside_voxels(vox_idx, shape):
+    '''
+    Returns a boolean array which is True for the rows of vox_idx that lie
+    inside a volume of the given shape.
+
+    Parameters
+    ----------
+    vox_idx: (N, 3) int array of voxel indices
+
+    shape: tuple
+    Shape of the volume, only the first three dimensions are used.
+
+    Returns
+    -------
+    (N, ) boolean numpy array
+    '''
+    return np.all((vox_idx >= 0) & (vox_idx < np.array(shape[:3])), axis=1)
+
+
+def get_voxels_bbox(vox_idx):
+    '''
+    Returns the bounding box of a non-empty set of voxels.
+
+    Parameters
+    ----------
+    vox_idx: tuple of three int arrays
+    Voxel indices, as returned by mask_to_atlas_voxels.
+
+    Returns
+    -------
+    bbox_min, bbox_max: int numpy arrays with the lowest and highest index
+    of the voxels in each dimension
+    '''
+    return (np.array([idx.min() for idx in vox_idx]),
+            np.array([idx.max() for idx in vox_idx]))
+
+
+def get_num_mask_volumes(mask_img):
+    '''
+    Returns the number of volumes of a 4D mask_img, None for 3D masks.
+    Trailing dimensions of length 1 are ignored, so a (X, Y, Z, 1) mask is
+    a 3D mask.
+    '''
+    n_vols = int(np.prod(mask_img.shape[3:]))
+
+    return n_vols if n_vols > 1 else None
+
+
+def get_mask_matrix(mask_img):
+    '''
+    Returns the data of mask_img as a (n_voxels, n_volumes) matrix, with
+    the voxels in C order, or as a flat array of voxel values for 3D masks.
+    '''
+    mask_vol = np.asarray(mask_img.get_data())
+
+    n_vols = get_num_mask_volumes(mask_img)
+    if n_vols is None:
+        return mask_vol.ravel()
+
+    return mask_vol.reshape((-1, n_vols))
+
+
+def get_mask_sums(mask_img):
+    '''
+    Returns the sum of the values of mask_img, or an array with the sum of
+    each volume for 4D masks.
+    '''
+    return np.sum(get_mask_matrix(mask_img), axis=0, dtype=float)
+
+
+def get_zero_values(mask_img):
+    '''
+    Returns 0., or an array of zeros with one per volume for 4D masks, as
+    the result of a query of mask_img that does not meet any structure.
+    '''
+    n_vols = get_num_mask_volumes(mask_img)
+
+    return 0. if n_vols is None else np.zeros(n_vols)
+
+
+def map_grid_voxels(src_img, dst_img, src_flat):
+    '''
+    Maps voxels of the src_img grid to the nearest voxels of the dst_img
+    grid.
+
+    Parameters
+    ----------
+    src_img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    dst_img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    src_flat: int array
+    Flat (C order) indices of the src_img voxels.
+
+    Returns
+    -------
+    int numpy array with the flat index of the dst_img voxel of each voxel
+    in src_flat, -1 for the voxels that fall outside of dst_img.
+    '''
+    src_geom = get_geometry(src_img)
+    dst_geom = get_geometry(dst_img)
+    dst_shape = tuple(dst_geom.shape)
+
+    src_idx = np.column_stack(np.unravel_index(src_flat,
+                                               tuple(src_geom.shape)))
+    dst_idx = np.round(apply_affine(get_vox2vox_affine(src_geom, dst_geom),
+                                    src_idx)).astype(int)
+
+    inside = get_inside_voxels(dst_idx, dst_shape)
+    dst_flat = -np.ones(len(src_flat), dtype=np.int64)
+    dst_flat[inside] = np.ravel_multi_index(tuple(dst_idx[inside].T),
+                                            dst_shape)
+
+    return dst_flat
+
+
+class GridMapCache:
+    '''
+    LRU cache of the voxel maps between pairs of image grids. Each map
+    holds, for every voxel of the source grid, the flat index of the
+    nearest voxel of the destination grid, and is filled in lazily: only
+    the voxels of the masks queried so far are transformed, so masks that
+    share a grid with an already queried mask skip the transform of the
+    voxels they have in common. The cache is bounded by the bytes of its
+    maps, and can be shared by threads.
+    '''
+
+    # marks the voxels of a map that have not been transformed yet
+    unmapped = -2
+
+    def __init__(self, max_bytes=128 * 2**20):
+        '''
+        Parameters
+        ----------
+        max_bytes: int
+        Maximum size of the maps kept, the least recently used ones are
+        evicted first. Grids whose map alone is larger are not cached.
+        '''
+        self.max_bytes = max_bytes
+        self.grid_maps = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get_key(self, src_geom, dst_geom):
+        '''
+        Returns the cache key of the pair of grids
+        '''
+        return (tuple(src_geom.shape), tuple(src_geom.affine.ravel()),
+                tuple(dst_geom.shape), tuple(dst_geom.affine.ravel()))
+
+
+    def _get_grid_map(self, src_geom, dst_geom):
+        '''
+        Returns the cached map from src_geom to dst_geom, creating an empty
+        one if there is none, or None if the map does not fit in the cache.
+        '''
+        key = self.get_key(src_geom, dst_geom)
+
+        with self.lock:
+            grid_map = self.grid_maps.pop(key, None)
+
+            if grid_map is None:
+                n_dst = int(np.prod(dst_geom.shape))
+                dtype = np.int32 if n_dst < 2**31 else np.int64
+                n_src = int(np.prod(src_geom.shape))
+                if n_src * np.dtype(dtype).itemsize > self.max_bytes:
+                    return None
+
+                grid_map = np.empty(n_src, dtype=dtype)
+                grid_map.fill(self.unmapped)
+
+            self.grid_maps[key] = grid_map
+
+            n_bytes = sum(m.nbytes for m in self.grid_maps.values())
+            while n_bytes > self.max_bytes:
+                n_bytes -= self.grid_maps.popitem(last=False)[1].nbytes
+
+        return grid_map
+
+
+    def map_voxels(self, src_geom, dst_geom, src_flat):
+        '''
+        Returns the flat index of the dst_geom voxel of each src_geom voxel
+        in src_flat, see map_grid_voxels, transforming only the voxels that
+        are not in the cache yet.
+
+        Parameters
+        ----------
+        src_geom: ImageGeometry
+
+        dst_geom: ImageGeometry
+
+        src_flat: int array
+        Flat (C order) indices of the src_geom voxels.
+
+        Returns
+        -------
+        int numpy array, -1 for the voxels that fall outside of dst_geom.
+        '''
+        grid_map = self._get_grid_map(src_geom, dst_geom)
+        if grid_map is None:
+            return map_grid_voxels(src_geom, dst_geom, src_flat)
+
+        dst_flat = grid_map[src_flat]
+
+        missing = np.flatnonzero(dst_flat == self.unmapped)
+        profiling.count('grid_map_cached_voxels', len(src_flat) - len(missing))
+        profiling.count('grid_map_mapped_voxels', len(missing))
+
+        if len(missing):
+            with profiling.span('grid_map_build'):
+                dst_flat[missing] = map_grid_voxels(src_geom, dst_geom,
+                                                    src_flat[missing])
+            # threads mapping the same voxels write the same values
+            grid_map[src_flat[missing]] = dst_flat[missing]
+
+        return dst_flat
+
+
+    def clear(self):
+        '''
+        '''
+        with self.lock:
+            self.grid_maps.clear()
+
+
+grid_map_cache = GridMapCache()
+
+
+def mask_to_atlas_voxels(mask_img, atlas_img):
+    '''
+    Maps all the non-zero voxels of mask_img to atlas_img voxel indices.
+    Each mask voxel is assigned to the nearest atlas voxel and the ones
+    falling outside of the atlas volume are discarded.
+    The voxels of 4D masks are mapped once for all their volumes, keeping
+    the voxels that are non-zero in any volume.
+    When both images are on the same grid the mask voxels are used as they
+    are, otherwise they are mapped through grid_map_cache.
+
+    Parameters
+    ----------
+    mask_img: nib.Nifti1Image or nipy Image
+    3D or 4D mask.
+
+    atlas_img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    Returns
+    -------
+    atlas_idx: tuple of three int arrays
+    Atlas voxel indices, ready for fancy indexing of the atlas volume.
+
+    weights: numpy array
+    Mask values of the voxels in atlas_idx, a (n_voxels, n_volumes) matrix
+    for 4D masks.
+    '''
+    with profiling.span('mask_data_read'):
+        mask_mat = get_mask_matrix(mask_img)
+
+    if mask_mat.ndim == 1:
+        mask_flat = np.flatnonzero(mask_mat)
+    else:
+        mask_flat = np.flatnonzero(np.any(mask_mat, axis=1))
+
+    weights = mask_mat[mask_flat]
+    profiling.count('mask_voxels', len(mask_flat))
+
+    mask_geom = get_geometry(mask_img)
+    atlas_geom = get_geometry(atlas_img)
+
+    if are_same_grid(mask_geom, atlas_geom):
+        return np.unravel_index(mask_flat, tuple(atlas_geom.shape)), weights
+
+    atlas_flat = grid_map_cache.map_voxels(mask_geom, atlas_geom, mask_flat)
+    inside = atlas_flat >= 0
+
+    atlas_idx = np.unravel_index(atlas_flat[inside], tuple(atlas_geom.shape))
+
+    return atlas_idx, weights[inside]
+
+
+def get_mask_dataobj(mask_img):
+    '''
+    Returns the nibabel array proxy of mask_img, or its data array for
+    images without one, like nipy Images.
+    '''
+    dataobj = getattr(mask_img, 'dataobj', None)
+    if dataobj is None:
+        dataobj = np.asarray(mask_img.get_data())
+
+    return dataobj
+
+
+def iter_mask_slabs(mask_img, memory_budget):
+    '''
+    Reads mask_img in z-slabs through its array proxy, so only one slab of
+    the mask is in memory at a time.
+
+    Parameters
+    ----------
+    mask_img: nib.Nifti1Image or nipy Image
+    3D or 4D mask.
+
+    memory_budget: int
+    Maximum number of bytes of a slab. Slabs have at least one z plane.
+
+    Returns
+    -------
+    Iterator of (z, slab) tuples, with z the first plane of the slab and
+    slab a (X, Y, depth) array, or a (X, Y, depth, n_volumes) array for 4D
+    masks.
+    '''
+    dataobj = get_mask_dataobj(mask_img)
+    shape = tuple(mask_img.shape)
+    n_vols = get_num_mask_volumes(mask_img)
+
+    plane_bytes = shape[0] * shape[1] * (n_vols or 1) * \
+                  get_read_itemsize(dataobj)
+    depth = int(max(1, memory_budget // plane_bytes))
+
+    for z in range(0, shape[2], depth):
+        with profiling.span('mask_data_read'):
+            slab = np.asarray(dataobj[:, :, z:z + depth])
+
+        if n_vols is None:
+            slab = slab.reshape(slab.shape[:3])
+        else:
+            slab = slab.reshape(slab.shape[:3] + (n_vols,))
+
+        yield z, slab
+
+
+def iter_mask_atlas_voxels(mask_img, atlas_img, memory_budget):
+    '''
+    Maps the non-zero voxels of mask_img to atlas_img voxel indices like
+    mask_to_atlas_voxels, one z-slab of mask_img at a time, see
+    iter_mask_slabs. The coordinates of each slab are transformed on the
+    fly instead of through a grid map of the whole mask, so the memory used
+    is proportional to one slab.
+
+    Parameters
+    ----------
+    mask_img: nib.Nifti1Image or nipy Image
+    3D or 4D mask.
+
+    atlas_img: nib.Nifti1Image, nipy Image or ImageGeometry
+
+    memory_budget: int
+    Maximum number of bytes of mask data read at once.
+
+    Returns
+    -------
+    Iterator of (atlas_idx, weights, mask_sums) tuples for each slab, with
+    atlas_idx and weights as in mask_to_atlas_voxels and mask_sums the sum
+    of the values of the slab, an array with one sum per volume for 4D
+    masks.
+    '''
+    mask_geom = get_geometry(mask_img)
+    atlas_geom = get_geometry(atlas_img)
+    atlas_shape = tuple(atlas_geom.shape)
+
+    vox2vox = None
+    if not are_same_grid(mask_geom, atlas_geom):
+        vox2vox = get_vox2vox_affine(mask_geom, atlas_geom)
+
+    for z, slab in iter_mask_slabs(mask_img, memory_budget):
+        if slab.ndim == 3:
+            mask_mat = slab.ravel()
+            mask_flat = np.flatnonzero(mask_mat)
+        else:
+            mask_mat = slab.reshape((-1, slab.shape[3]))
+            mask_flat = np.flatnonzero(np.any(mask_mat, axis=1))
+
+        mask_sums = np.sum(mask_mat, axis=0, dtype=float)
+        weights = mask_mat[mask_flat]
+        profiling.count('mask_voxels', len(mask_flat))
+
+        i, j, k = np.unravel_index(mask_flat, slab.shape[:3])
+        mask_idx = np.column_stack((i, j, k + z))
+
+        if vox2vox is None:
+            yield tuple(mask_idx.T), weights, mask_sums
+            continue
+
+        atlas_idx = np.round(apply_affine(vox2vox, mask_idx)).astype(int)
+        inside = get_inside_voxels(atlas_idx, atlas_shape)
+
+        yield tuple(atlas_idx[inside].T), weights[inside], mask_sums
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+
+import time
+import threading
+from contextlib import contextmanager
+
+'''
+Lightweight instrumentation of the atlasquerpy hot paths.
+Timing spans and counters are only recorded while profiling is enabled:
+
+import profiling
+profiling.enable()
+... atlas queries ...
+print(profiling.format_report())
+
+Embedding callers can also receive every span and counter update as it
+happens with add_hook.
+'''
+
+_enabled = False
+_lock = threading.Lock()
+
+_spans = {}
+_counters = {}
+_hooks = []
+
+
+def enable():
+    '''
+    Starts recording spans and counters
+    '''
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    '''
+    Stops recording spans and counters
+    '''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    '''
+    '''
+    return _enabled
+
+
+def reset():
+    '''
+    Clears all the recorded spans and counters
+    '''
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def add_hook(hook):
+    '''
+    Registers hook to be called as hook(kind, name, value) on every
+    recorded event, where kind is 'span', with value the elapsed seconds,
+    or 'count', with value the counter increment.
+    '''
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    '''
+    '''
+    _hooks.remove(hook)
+
+
+def _call_hooks(kind, name, value):
+    '''
+    '''
+    for hook in _hooks:
+        hook(kind, name, value)
+
+
+@contextmanager
+def span(name):
+    '''
+    Context manager that times its block as a span called name.
+    Nested spans are recorded independently, so the time of a span
+    includes the time of the spans inside it.
+    '''
+    if not _enabled:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+
+        with _lock:
+            calls, total = _spans.get(name, (0, 0.))
+            _spans[name] = (calls + 1, total + elapsed)
+
+        _call_hooks('span', name, elapsed)
+
+
+def count(name, value=1):
+    '''
+    Adds value to the counter called name
+    '''
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+    _call_hooks('count', name, value)
+
+
+def get_report():
+    '''
+    Returns the recorded spans and counters as a dict:
+    {'spans': {name: {'calls': int, 'seconds': float}},
+     'counters': {name: value}}
+    '''
+    with _lock:
+        spans = dict((name, {'calls': calls, 'seconds': total})
+                     for name, (calls, total) in _spans.items())
+        counters = dict(_counters)
+
+    return {'spans': spans, 'counters': counters}
+
+
+def format_report(report=None):
+    '''
+    Returns a per-phase text table of report, the current report by
+    default.
+    '''
+    if report is None:
+        report = get_report()
+
+    lines = ['%-28s %8s %12s' % ('phase', 'calls', 'seconds')]
+
+    spans = report['spans']
+    for name in sorted(spans, key=lambda n: -spans[n]['seconds']):
+        lines.append('%-28s %8d %12.6f' % (name, spans[name]['calls'],
+                                           spans[name]['seconds']))
+
+    if report['counters']:
+        lines.append('')
+        lines.append('%-28s %21s' % ('counter', 'value'))
+        for name in sorted(report['counters']):
+            lines.append('%-28s %21d' % (name, report['counters'][name]))
+
+    return '\n'.join(lines)
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+import numpy as np
+
+
+class QuantizedVolume:
+    '''
+    Compact storage of a probabilistic atlas volume.
+    The probabilities are kept as unsigned integers, multiplied by a power
+    of ten scale, in uint8 when they fit and uint16 otherwise. Indexing it
+    like a numpy array widens the selected values back to the dtype of the
+    original volume, so only the values being accumulated are ever held as
+    floats and they are identical to the original ones.
+    '''
+
+    def __init__(self, data, scale, dtype):
+        '''
+        Parameters
+        ----------
+        data: uint8 or uint16 numpy array
+        Quantized probabilities, see quantize_volume.
+
+        scale: int
+        Factor the probabilities were multiplied by.
+
+        dtype: numpy dtype
+        Data type of the original volume.
+        '''
+        self.data = data
+        self.scale = scale
+        self.dtype = np.dtype(dtype)
+
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+
+    @property
+    def nbytes(self):
+        '''
+        Memory used by the quantized data, in bytes
+        '''
+        return self.data.nbytes
+
+
+    def __getitem__(self, index):
+        return dequantize(self.data[index], self.scale, self.dtype)
+
+
+def dequantize(values, scale, dtype):
+    '''
+    Returns the quantized values divided by scale, as dtype.
+
+    Parameters
+    ----------
+    values: numpy array or numpy scalar
+
+    scale: int
+
+    dtype: numpy dtype
+    '''
+    if scale == 1:
+        return values.astype(dtype)
+
+    return (values / float(scale)).astype(dtype)
+
+
+def quantize_volume(prob_vol, precision=0):
+    '''
+    Returns prob_vol stored as a QuantizedVolume, or None if its values can
+    not be recovered exactly from integers with the given decimal precision
+    that fit in 16 bits.
+
+    Parameters
+    ----------
+    prob_vol: 4D numpy array
+    Probabilistic atlas volume, one 3D volume per structure.
+
+    precision: int
+    Number of decimals of the probabilities, as in the atlas header.
+
+    Returns
+    -------
+    QuantizedVolume or None
+    '''
+    scale = 10 ** max(int(precision), 0)
+
+    if not prob_vol.size or prob_vol.min() < 0:
+        return None
+
+    max_value = np.round(float(prob_vol.max()) * scale)
+    if max_value <= np.iinfo(np.uint8).max:
+        q_dtype = np.uint8
+    elif max_value <= np.iinfo(np.uint16).max:
+        q_dtype = np.uint16
+    else:
+        return None
+
+    # one structure volume at a time, to bound the temporary copies
+    data = np.empty(prob_vol.shape, dtype=q_dtype)
+    for v in range(prob_vol.shape[3]):
+        vol = np.asarray(prob_vol[:, :, :, v])
+        q_vol = np.round(vol * float(scale)).astype(q_dtype)
+
+        if not np.array_equal(dequantize(q_vol, scale, prob_vol.dtype), vol):
+            return None
+
+        data[:, :, :, v] = q_vol
+
+    return QuantizedVolume(data, scale, prob_vol.dtype)
@@ -0,0 +1,394 @@
+#!/usr/bin/python
+
+import os
+import json
+import signal
+import socket
+import multiprocessing
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+import numpy as np
+import nibabel as nib
+from atlas import StatsAtlas
+from atlas_group import AtlasGroup
+
+
+_atlas_group = None
+
+
+def parse_address(address):
+    '''
+    Returns the socket address given in address: a (host, port) tuple for
+    <HOST>:<PORT> strings or the path of a Unix socket otherwise.
+    '''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+
+    return address
+
+
+def is_loopback_address(host):
+    '''
+    Returns True if host resolves only to loopback addresses, like
+    localhost, 127.0.0.1 or ::1.
+    '''
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+
+    addresses = set(info[4][0] for info in infos)
+
+    return bool(addresses) and all(addr.startswith('127.') or addr == '::1'
+                                   for addr in addresses)
+
+
+def query_mask_values(atlas, mask_img, measure):
+    '''
+    Returns a list of [structure name, value] pairs of the atlas structures
+    with a positive measure in mask_img, sorted by structure index.
+    For 4D masks the value is the list of values of every mask volume.
+
+    Parameters
+    ----------
+    atlas: Atlas
+
+    mask_img: nib.Nifti1Image
+    3D or 4D mask.
+
+    measure: string
+    'avgprob' or 'roiover', see Atlas.query_mask_all
+    '''
+    return get_structure_values(atlas, atlas.query_mask_all(mask_img, measure))
+
+
+def get_structure_values(atlas, values):
+    '''
+    Returns a list of [structure name, value] pairs of the positive values
+    in values, sorted by structure index.
+    Structures with an array of values, one per mask volume, are kept if
+    any of them is positive and their value is the list of those values.
+
+    Parameters
+    ----------
+    atlas: Atlas
+
+    values: dict
+    Value of each structure index, as returned by Atlas.query_mask_all
+    '''
+    mask_values = []
+    for li in sorted(values.keys()):
+        if np.ndim(values[li]):
+            if np.any(values[li] > 0):
+                mask_values.append([atlas.get_structure_name(li),
+                                    [float(v) for v in values[li]]])
+        elif values[li] > 0:
+            mask_values.append([atlas.get_structure_name(li),
+                                float(values[li])])
+
+    return mask_values
+
+
+def _init_worker(volume_cache, compact=False, memory_budget=None,
+                 n_threads=None):
+    '''
+    Creates the AtlasGroup of a worker process that did not inherit one.
+    '''
+    global _atlas_group
+    if _atlas_group is None:
+        _atlas_group = AtlasGroup(volume_cache=volume_cache, compact=compact,
+                                  memory_budget=memory_budget,
+                                  n_threads=n_threads)
+
+
+def run_query(query):
+    '''
+    Answers one query with the AtlasGroup of the current process.
+
+    Parameters
+    ----------
+    query: dict
+    {'op': 'atlases'} to list the atlas names,
+    {'op': 'coords', 'atlas': name, 'coords': [x, y, z], 'threshold': thr}
+    to describe a mm coordinate, with an optional max probability
+    threshold, or
+    {'op': 'mask', 'atlas': name, 'mask': path, 'type': measure} for the
+    structures values of a mask, see query_mask_values.
+
+    Returns
+    -------
+    dict with the 'result' of the query or the 'error' message if it failed
+    '''
+    try:
+        op = query.get('op')
+
+        if op == 'atlases':
+            return {'result': sorted(_atlas_group.get_atlas_names())}
+
+        atlas = _atlas_group.get_atlas_by_name(query.get('atlas'))
+        if atlas is None:
+            return {'error': 'Invalid atlas name ' + str(query.get('atlas'))}
+
+        if op == 'coords':
+            if isinstance(atlas, StatsAtlas):
+                atlas.get_sparse_index()
+            x, y, z = query['coords']
+            threshold = query.get('threshold')
+            if threshold is not None:
+                threshold = float(threshold)
+            result = atlas.get_description(float(x), float(y), float(z),
+                                           threshold)
+
+        elif op == 'mask':
+            mask_img = nib.load(query['mask'])
+            result = query_mask_values(atlas, mask_img,
+                                       query.get('type', 'avgprob'))
+
+        else:
+            return {'error': 'Unknown query ' + str(op)}
+
+    except Exception as exc:
+        return {'error': str(exc)}
+
+    return {'result': result}
+
+
+def _raise_interrupt(signum, frame):
+    '''
+    Signal handler that stops the server as a KeyboardInterrupt would.
+    '''
+    raise KeyboardInterrupt()
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    '''
+    Reads one JSON query per line from the connection and writes one JSON
+    answer line for each of them.
+    '''
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            if not line.strip():
+                continue
+
+            try:
+                query = json.loads(line.decode('utf-8'))
+            except ValueError:
+                answer = {'error': 'Invalid query'}
+            else:
+                answer = self.server.run(query)
+
+            self.wfile.write((json.dumps(answer) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn,
+                         socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class QueryServer:
+    '''
+    Resident atlas query server. It keeps an AtlasGroup loaded in memory and
+    answers queries from QueryClients over a Unix socket or a localhost TCP
+    port. Every connection is served by its own thread and the queries are
+    run in a pool of worker processes.
+    Mask queries open any file path the client sends, so the server only
+    listens on loopback addresses unless allow_remote is set.
+    '''
+
+    def __init__(self, address, n_workers=None, preload=(),
+                 volume_cache=False, compact=False, memory_budget=None,
+                 n_threads=None, allow_remote=False):
+        '''
+        Parameters
+        ----------
+        address: string or (host, port) tuple
+        Unix socket path or TCP address to listen on.
+
+        n_workers: int
+        Number of worker processes, the number of CPUs by default. With 0
+        the queries are run in the connection threads.
+
+        preload: list of strings
+        Names of the atlases to load, with their data, before the workers
+        are started, so they share them with the server process. They are
+        loaded concurrently, see AtlasGroup.load_atlases, and the sparse
+        index of the statistical ones is built, see
+        StatsAtlas.get_sparse_index. Atlases that are not preloaded are
+        loaded by each worker process on its first query of them, so every
+        worker keeps its own copy of their data.
+
+        volume_cache, compact: boolean
+        See AtlasGroup.
+
+        memory_budget, n_threads: int
+        See AtlasGroup.
+
+        allow_remote: boolean
+        True to accept TCP addresses that are not loopback addresses.
+        Raises ValueError for them otherwise.
+        '''
+        global _atlas_group
+
+        if (isinstance(address, tuple) and not allow_remote and
+            not is_loopback_address(address[0])):
+            raise ValueError('Refusing to listen on non-loopback address ' +
+                             str(address[0]) + ' without allow_remote ' +
+                             '(--allow-remote)')
+
+        self.address = address
+
+        _atlas_group = AtlasGroup(volume_cache=volume_cache, compact=compact,
+                                  memory_budget=memory_budget,
+                                  n_threads=n_threads)
+
+        atlases = _atlas_group.load_atlases(list(preload))
+        for name, atlas in zip(preload, atlases):
+            if atlas is None:
+                raise ValueError('Invalid atlas name ' + name)
+            if isinstance(atlas, StatsAtlas):
+                # built before forking, so the workers share it
+                atlas.get_sparse_index()
+
+        self.pool = None
+        if n_workers != 0:
+            self.pool = multiprocessing.Pool(n_workers, _init_worker,
+                                             (volume_cache, compact,
+                                              memory_budget, n_threads))
+
+        if isinstance(address, tuple):
+            self.server = ThreadingTCPServer(address, QueryHandler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            elif not os.path.isdir(os.path.dirname(os.path.abspath(address))):
+                os.makedirs(os.path.dirname(os.path.abspath(address)))
+            self.server = ThreadingUnixServer(address, QueryHandler)
+
+        self.server.run = self.run
+
+
+    def run(self, query):
+        '''
+        Answers query in the worker pool, see run_query.
+        '''
+        if self.pool is None:
+            return run_query(query)
+
+        return self.pool.apply(run_query, (query,))
+
+
+    def serve_forever(self):
+        '''
+        Serves queries until interrupted or terminated.
+        '''
+        signal.signal(signal.SIGTERM, _raise_interrupt)
+
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+
+    def close(self):
+        '''
+        Stops the worker pool and removes the Unix socket.
+        '''
+        self.server.server_close()
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class QueryClient:
+    '''
+    Client of a QueryServer.
+    '''
+
+    def __init__(self, address):
+        '''
+        Parameters
+        ----------
+        address: string or (host, port) tuple
+        Unix socket path or TCP address of the server.
+        '''
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+
+        self.sock_file = self.sock.makefile('rb')
+
+
+    def query(self, query):
+        '''
+        Sends query to the server and returns its result.
+        Raises RuntimeError with the server message if the query failed.
+
+        Parameters
+        ----------
+        query: dict, see run_query
+        '''
+        self.sock.sendall((json.dumps(query) + '\n').encode('utf-8'))
+
+        line = self.sock_file.readline()
+        if not line:
+            raise RuntimeError('Connection closed by the server')
+
+        answer = json.loads(line.decode('utf-8'))
+        if 'error' in answer:
+            raise RuntimeError(answer['error'])
+
+        return answer['result']
+
+
+    def get_atlas_names(self):
+        '''
+        Returns the names of the atlases available in the server
+        '''
+        return [str(name) for name in self.query({'op': 'atlases'})]
+
+
+    def get_description(self, atlas_name, x, y, z, threshold=None):
+        '''
+        Returns the description of the x, y, z mm coordinate in the atlas,
+        see Atlas.get_description.
+        '''
+        return self.query({'op': 'coords', 'atlas': atlas_name,
+                           'coords': [x, y, z], 'threshold': threshold})
+
+
+    def get_mask_values(self, atlas_name, mask_file, measure='avgprob'):
+        '''
+        Returns the [structure name, value] pairs of mask_file in the atlas,
+        see query_mask_values.
+        '''
+        return self.query({'op': 'mask', 'atlas': atlas_name,
+                           'mask': os.path.abspath(mask_file),
+                           'type': measure})
+
+
+    def close(self):
+        '''
+        '''
+        self.sock_file.close()
+        self.sock.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import numpy as np
+
+from chunked_reader import iter_volume_chunks
+
+
+class SparseProbIndex:
+    '''
+    Compact CSR-like index of a 4D probabilistic atlas volume.
+    For every voxel it keeps only the structures with non-zero probability
+    and their probabilities, so the lookup of a voxel costs
+    O(non-zero structures at that voxel).
+    '''
+
+    def __init__(self, prob_vol, memory_budget=None):
+        '''
+        Parameters
+        ----------
+        prob_vol: 4D numpy array, or array-like indexed in the same way,
+        like a nibabel array proxy
+        Probabilistic atlas volume, one 3D volume per structure.
+
+        memory_budget: int
+        Maximum number of bytes of prob_vol read at once, see
+        chunked_reader.iter_volume_chunks. None to read one structure
+        volume at a time.
+        '''
+        self.shape = prob_vol.shape[:3]
+        self.n_structs = prob_vol.shape[3]
+
+        n_vox = int(np.prod(self.shape))
+        struct_dtype = np.int16 if self.n_structs < 2**15 else np.int32
+
+        voxels = []
+        structs = []
+        probs = []
+        for offset, vol_pos, chunk in iter_volume_chunks(prob_vol,
+                                                         memory_budget):
+            for n, v in enumerate(vol_pos):
+                vol = chunk[..., n]
+                nz_idx = np.nonzero(vol)
+
+                voxels.append(np.ravel_multi_index(
+                    tuple(idx + o for idx, o in zip(nz_idx, offset)),
+                    self.shape))
+                structs.append(np.ones(len(nz_idx[0]), dtype=struct_dtype) * v)
+                probs.append(vol[nz_idx])
+
+        voxels = np.concatenate(voxels)
+        order = np.argsort(voxels, kind='mergesort')
+
+        self.structs = np.concatenate(structs)[order]
+        self.probs = np.concatenate(probs)[order]
+
+        counts = np.bincount(voxels, minlength=n_vox)
+        self.indptr = np.zeros(n_vox + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+
+    @property
+    def nbytes(self):
+        '''
+        Memory used by the index arrays, in bytes
+        '''
+        return self.indptr.nbytes + self.structs.nbytes + self.probs.nbytes
+
+
+    def lookup(self, i, j, k):
+        '''
+        Returns the structures with non-zero probability at voxel i, j, k.
+
+        Parameters
+        ----------
+        i, j, k: int
+        Voxel coordinates
+
+        Returns
+        -------
+        structs: numpy array of structure indices, in ascending order
+
+        probs: numpy array with the probability of each structure
+        '''
+        vox = np.ravel_multi_index((i, j, k), self.shape)
+        start, end = self.indptr[vox], self.indptr[vox + 1]
+
+        return self.structs[start:end], self.probs[start:end]
+
+
+    def get_values(self, vox_idx, structs=None):
+        '''
+        Returns the probabilities of the structures at the voxels vox_idx,
+        gathering the index entries of all the voxels at once.
+
+        Parameters
+        ----------
+        vox_idx: tuple of three int arrays
+        Voxel indices.
+
+        structs: int array-like
+        Indices of the structures, all of them by default.
+
+        Returns
+        -------
+        (N, n_structures) array, or (N, len(structs)) array
+        '''
+        vox = np.ravel_multi_index(tuple(np.asarray(idx, dtype=int)
+                                         for idx in vox_idx), self.shape)
+
+        starts = self.indptr[vox]
+        counts = self.indptr[vox + 1] - starts
+
+        # positions in self.structs of the entries of every voxel, and the
+        # row of each of them
+        rows = np.repeat(np.arange(len(vox)), counts)
+        pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+        pos += np.repeat(starts, counts)
+
+        values = np.zeros((len(vox), self.n_structs), dtype=self.probs.dtype)
+        values[rows, self.structs[pos]] = self.probs[pos]
+
+        if structs is not None:
+            values = values[:, structs]
+
+        return values
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import numpy as np
+
+from chunked_reader import iter_volume_chunks
+
+
+class StructureStats:
+    '''
+    Per-structure summary of an atlas image: the probability mass, the
+    number of voxels, the centroid and the bounding box of every structure.
+    They are computed in one pass over the atlas volume and kept in the
+    metadata cache, so queries only need to look them up.
+    Centroids and bounding boxes are in voxel coordinates of the atlas
+    image; structures without voxels have an empty bounding box, with
+    bbox_min above bbox_max.
+    '''
+
+    def __init__(self, mass, n_voxels, centroids, bbox_min, bbox_max):
+        '''
+        Parameters
+        ----------
+        mass: (n_structures, ) array-like
+        Sum of the probabilities of each structure, in percentage units.
+
+        n_voxels: (n_structures, ) array-like
+        Number of voxels with a non-zero value of each structure.
+
+        centroids: (n_structures, 3) array-like
+        Probability weighted centroid of each structure, in voxels.
+
+        bbox_min, bbox_max: (n_structures, 3) array-like
+        Lowest and highest voxel indices of each structure.
+        '''
+        self.mass = np.asarray(mass, dtype=float)
+        self.n_voxels = np.asarray(n_voxels, dtype=np.int64)
+        self.centroids = np.asarray(centroids, dtype=float).reshape(-1, 3)
+        self.bbox_min = np.asarray(bbox_min, dtype=np.int64).reshape(-1, 3)
+        self.bbox_max = np.asarray(bbox_max, dtype=np.int64).reshape(-1, 3)
+
+
+    def __len__(self):
+        return len(self.mass)
+
+
+    def to_dict(self):
+        '''
+        Returns a JSON serializable dict of the stats arrays
+        '''
+        return {'mass': self.mass.tolist(),
+                'n_voxels': self.n_voxels.tolist(),
+                'centroids': self.centroids.tolist(),
+                'bbox_min': self.bbox_min.tolist(),
+                'bbox_max': self.bbox_max.tolist()}
+
+
+    def find_overlapping(self, bbox_min, bbox_max):
+        '''
+        Returns the indices of the structures whose bounding box intersects
+        the bounding box from bbox_min to bbox_max, both included.
+
+        Parameters
+        ----------
+        bbox_min, bbox_max: 3 int array-like
+        Voxel indices of opposite corners of the bounding box.
+
+        Returns
+        -------
+        int numpy array
+        '''
+        overlap = np.all((self.bbox_min <= np.asarray(bbox_max)) &
+                         (self.bbox_max >= np.asarray(bbox_min)), axis=1)
+
+        return np.flatnonzero(overlap)
+
+
+def structure_stats_from_dict(stats):
+    '''
+    Returns the StructureStats stored in stats, see StructureStats.to_dict.
+    '''
+    return StructureStats(stats['mass'], stats['n_voxels'],
+                          stats['centroids'], stats['bbox_min'],
+                          stats['bbox_max'])
+
+
+def _get_empty_bboxes(n_structs, shape):
+    '''
+    Returns bbox_min, bbox_max arrays of n_structs empty bounding boxes
+    '''
+    bbox_min = np.tile(np.array(shape[:3], dtype=np.int64), (n_structs, 1))
+    bbox_max = -np.ones((n_structs, 3), dtype=np.int64)
+
+    return bbox_min, bbox_max
+
+
+def _add_voxel_stats(stats, v, vox_idx, probs):
+    '''
+    Adds the voxels vox_idx of structure v, with probabilities probs, to
+    the (mass, n_voxels, centroid_sums, bbox_min, bbox_max) arrays in
+    stats.
+    '''
+    mass, n_voxels, centroid_sums, bbox_min, bbox_max = stats
+
+    mass[v] += np.sum(probs)
+    n_voxels[v] += len(probs)
+    centroid_sums[v] += [np.dot(idx, probs) for idx in vox_idx]
+    bbox_min[v] = np.minimum(bbox_min[v], [idx.min() for idx in vox_idx])
+    bbox_max[v] = np.maximum(bbox_max[v], [idx.max() for idx in vox_idx])
+
+
+def _get_centroids(mass, centroid_sums):
+    '''
+    Returns the centroids from their probability weighted coordinate sums,
+    zeros for the structures without mass.
+    '''
+    centroids = np.zeros(centroid_sums.shape)
+    found = mass > 0
+    centroids[found] = centroid_sums[found] / mass[found, np.newaxis]
+
+    return centroids
+
+
+def compute_prob_stats(prob_vol, memory_budget=None):
+    '''
+    Returns the StructureStats of a 4D probabilistic atlas volume, with one
+    3D volume per structure.
+
+    Parameters
+    ----------
+    prob_vol: 4D numpy array or nibabel array proxy
+
+    memory_budget: int
+    Maximum number of bytes read at once, see
+    chunked_reader.iter_volume_chunks. None to read one structure volume
+    at a time.
+    '''
+    n_structs = prob_vol.shape[3]
+
+    mass = np.zeros(n_structs)
+    n_voxels = np.zeros(n_structs, dtype=np.int64)
+    centroid_sums = np.zeros((n_structs, 3))
+    bbox_min, bbox_max = _get_empty_bboxes(n_structs, prob_vol.shape)
+    stats = (mass, n_voxels, centroid_sums, bbox_min, bbox_max)
+
+    for offset, vol_pos, chunk in iter_volume_chunks(prob_vol,
+                                                     memory_budget):
+        for n, v in enumerate(vol_pos):
+            vol = chunk[..., n]
+            nz_idx = np.nonzero(vol)
+            if not len(nz_idx[0]):
+                continue
+
+            probs = vol[nz_idx].astype(float)
+            vox_idx = [idx + o for idx, o in zip(nz_idx, offset)]
+            _add_voxel_stats(stats, v, vox_idx, probs)
+
+    return StructureStats(mass, n_voxels, _get_centroids(mass, centroid_sums),
+                          bbox_min, bbox_max)
+
+
+def compute_label_stats(lab_vol, n_labels=0, memory_budget=None,
+                        volume=None):
+    '''
+    Returns the StructureStats of a 3D label atlas volume, indexed by label
+    value. Every labelled voxel counts with a probability of 100.
+
+    Parameters
+    ----------
+    lab_vol: 3D int numpy array or nibabel array proxy
+
+    n_labels: int
+    Minimum number of structures of the result.
+
+    memory_budget: int
+    Maximum number of bytes read at once, see
+    chunked_reader.iter_volume_chunks. None to read the whole volume.
+
+    volume: int
+    Volume with the labels, for 4D lab_vol.
+    '''
+    volumes = None if volume is None else [volume]
+
+    n_structs = n_labels
+    n_voxels = np.zeros(n_structs, dtype=np.int64)
+    centroid_sums = np.zeros((n_structs, 3))
+    bbox_min, bbox_max = _get_empty_bboxes(n_structs, lab_vol.shape)
+
+    for offset, vol_pos, chunk in iter_volume_chunks(lab_vol, memory_budget,
+                                                     volumes):
+        if vol_pos is not None:
+            chunk = chunk[..., 0]
+
+        labs = chunk.ravel()
+        vox = np.flatnonzero(labs >= 0)
+        labs = labs[vox].astype(np.int64)
+        if not len(labs):
+            continue
+
+        if labs.max() >= n_structs:
+            n_new = labs.max() + 1 - n_structs
+            n_structs += n_new
+            n_voxels = np.r_[n_voxels, np.zeros(n_new, dtype=np.int64)]
+            centroid_sums = np.r_[centroid_sums, np.zeros((n_new, 3))]
+            new_min, new_max = _get_empty_bboxes(n_new, lab_vol.shape)
+            bbox_min = np.r_[bbox_min, new_min]
+            bbox_max = np.r_[bbox_max, new_max]
+
+        # group the voxels by label to reduce each coordinate per label
+        order = np.argsort(labs, kind='mergesort')
+        labs = labs[order]
+        vox_idx = np.unravel_index(vox[order], chunk.shape)
+
+        starts = np.flatnonzero(np.r_[True, labs[1:] != labs[:-1]])
+        found = labs[starts]
+
+        n_voxels[found] += np.diff(np.r_[starts, len(labs)])
+        for d, idx in enumerate(vox_idx):
+            idx = idx + offset[d]
+            centroid_sums[found, d] += np.add.reduceat(idx, starts)
+            bbox_min[found, d] = np.minimum(bbox_min[found, d],
+                                            np.minimum.reduceat(idx, starts))
+            bbox_max[found, d] = np.maximum(bbox_max[found, d],
+                                            np.maximum.reduceat(idx, starts))
+
+    mass = 100. * n_voxels
+    centroids = _get_centroids(n_voxels.astype(float), centroid_sums)
+
+    return StructureStats(mass, n_voxels, centroids, bbox_min, bbox_max)